@@ -13,7 +13,6 @@
 # TODO add in color coding / custom shapes for the bones (e.g. active, error, passive)
 # TODO maybe allow for changing the settings even if the armature is disabled
 # TODO only show the origin/joint for the selected/active bones
-# TODO add in support for different armatures for constraints
 # TODO add in automatic support for IK (without needing to manually setup constraints)
 # TODO display the error symbol on the Rigid Body header if there is an error
 # TODO if an error happens, disable all of the bones
@@ -22,7 +21,6 @@
 # TODO if dimensions are 0 (in any axis) then only create 0/2/4 vertices for the hitbox
 # TODO investigate the todo in clear_mesh
 # TODO if the user removes the RigidBodyWorld then a lot of stuff breaks
-# TODO if a constraint is added to a different armature, and that other armature is changed, it doesn't mark the first armature as dirty
 # TODO test whether it works properly when multiple armatures share the same bones
 
 # ---- Breaking changes
@@ -69,16 +67,21 @@ from . import properties
 from . import utils
 
 classes = (
-    properties.Dirty,
+    properties.Preferences,
     properties.Scene,
     properties.Error,
+    properties.Registered,
     properties.Armature,
     properties.Compound,
     properties.Constraint,
     properties.Bone,
 
     armatures.Update,
+    armatures.UpdateAll,
+    armatures.Rename,
     armatures.CleanupArmatures,
+    armatures.RepairUndo,
+    armatures.VerifyArmature,
     armatures.CopyFromActive,
     armatures.CalculateMass,
     armatures.BakeToKeyframes,
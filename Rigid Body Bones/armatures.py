@@ -1,24 +1,254 @@
-import re
+import time
+import hashlib
 import bpy
 from mathutils import Matrix
 from . import utils
 from . import events
+from . import plans
 from . import properties
 from .bones import (
     active_name, align_hitbox, blank_name, joint_name, align_joint, make_extra_joint,
     delete_parent, get_hitbox, hide_active_bone, is_bone_active, is_bone_enabled,
-    make_active_hitbox, make_blank_rigid_body, make_joint, make_empty_rigid_body,
-    make_passive_hitbox, remove_active, remove_blank, remove_joint,
-    remove_passive, store_parent, update_joint_constraint, update_hitbox_name,
+    make_active_hitboxes, make_blank_rigid_body, make_joint, make_empty_rigid_body,
+    make_passive_hitboxes, remove_blank, remove_joint,
+    store_parent, update_joint_constraint, update_hitbox_name,
     update_rigid_body, update_hitbox_shape, passive_name, remove_pose_constraint,
-    copy_properties, make_compound_hitbox, remove_compound, compound_name,
-    make_origin, origin_name, align_origin, remove_origin, compound_origin_name,
+    copy_properties, make_compound_hitboxes, compound_name,
+    make_origins, origin_name, align_origin, compound_origin_name,
     create_pose_constraint, update_joint_active, mute_pose_constraint,
-    sort_constraints,
+    ConstraintStack, update_pose_inverses, parent_transform, apply_parent_transform,
+    local_matrix,
 )
 
 
-DATA_PATH_REGEXP = re.compile(r"""^pose\.bones\["([^"]+)"\]""")
+# Snapshot of the bones after the last Update, this is used to figure
+# out which bones have changed so that Update doesn't need to
+# reconcile every bone in the armature.
+BONE_STATES = utils.BONE_STATES
+
+
+def rna_state(data):
+    state = []
+
+    for prop in data.bl_rna.properties:
+        name = prop.identifier
+
+        if name != "rna_type":
+            value = getattr(data, name)
+
+            if prop.type == 'COLLECTION':
+                value = tuple(rna_state(item) for item in value)
+
+            elif prop.type == 'POINTER':
+                if value is not None:
+                    # Objects are compared by name so that the state is stable
+                    if isinstance(value, bpy.types.ID):
+                        value = value.name
+                    else:
+                        value = rna_state(value)
+
+            elif getattr(prop, "array_length", 0) > 0:
+                value = tuple(value)
+
+            state.append(value)
+
+    return tuple(state)
+
+
+def matrix_state(matrix):
+    return tuple(tuple(row) for row in matrix)
+
+
+def bone_state(pose_bone):
+    bone = pose_bone.bone
+    parent = bone.parent
+
+    return (
+        None if parent is None else parent.name,
+        bone.use_connect,
+        bone.hide,
+        bone.length,
+        matrix_state(bone.matrix_local),
+        matrix_state(pose_bone.matrix_basis),
+        tuple(constraint.name for constraint in pose_bone.constraints),
+        rna_state(bone.rigid_body_bones),
+    )
+
+
+def clear_bone_states(armature):
+    BONE_STATES.pop(armature.as_pointer(), None)
+    BONE_DIGESTS.pop(armature.as_pointer(), None)
+
+
+def all_bone_states(armature):
+    return {pose_bone.name: bone_state(pose_bone) for pose_bone in armature.pose.bones}
+
+
+# The hitbox parents, kinematic flags, joints, Child Of constraints, and bone parents
+# of these bones depend on whether the simulation is active
+def depends_on_simulation(data):
+    return (is_bone_enabled(data) and is_bone_active(data)) or len(data.constraints) > 0
+
+
+# Armature pointer -> (digest of every bone, { bone name -> digest of the bone })
+#
+# The fingerprint combines the digests of the bones with XOR, so when only a few
+# bones change the fingerprint can be updated without hashing every bone
+BONE_DIGESTS = utils.BONE_DIGESTS
+
+
+# This is saved in the .blend file, so it must be the same in every Blender session
+def digest(value):
+    return int(hashlib.sha1(repr(value).encode("utf-8")).hexdigest(), 16)
+
+
+def bone_digests(states):
+    return {name: digest((name, state)) for (name, state) in states.items()}
+
+
+def combine_digests(digests):
+    total = 0
+
+    for value in digests.values():
+        total ^= value
+
+    return total
+
+
+def make_fingerprint(settings, total):
+    return "{:040x}".format(digest(settings) ^ total)
+
+
+# Armature pointer -> { bone name -> { slot -> object name } }
+#
+# This is an index for Armature.registry, so it doesn't need to search the registry
+REGISTRIES = utils.REGISTRIES
+
+
+# The name of the Root body in the registry
+ROOT_BONE = ""
+
+
+# The objects which are owned by a bone
+def bone_objects(data):
+    if data.active:
+        yield ('ACTIVE', data.active)
+
+    if data.passive:
+        yield ('PASSIVE', data.passive)
+
+    if data.origin_empty:
+        yield ('ORIGIN', data.origin_empty)
+
+    if data.blank:
+        yield ('BLANK', data.blank)
+
+    if data.constraint:
+        yield ('JOINT', data.constraint)
+
+    for compound in data.compounds:
+        if compound.hitbox:
+            yield ('COMPOUND ' + compound.name, compound.hitbox)
+
+        if compound.origin_empty:
+            yield ('COMPOUND ORIGIN ' + compound.name, compound.origin_empty)
+
+    for joint in data.constraints:
+        if joint.constraint:
+            yield ('CONSTRAINT ' + joint.name, joint.constraint)
+
+
+def bone_slots(data):
+    return {slot: object.name for (slot, object) in bone_objects(data)}
+
+
+def root_slots(top):
+    if top.root_body:
+        return {'ROOT': top.root_body.name}
+    else:
+        return {}
+
+
+def set_registry_slots(registry, bone_name, slots):
+    if len(slots) == 0:
+        registry.pop(bone_name, None)
+    else:
+        registry[bone_name] = slots
+
+
+def build_registry(armature, top):
+    registry = {}
+
+    for bone in armature.data.bones:
+        set_registry_slots(registry, bone.name, bone_slots(bone.rigid_body_bones))
+
+    set_registry_slots(registry, ROOT_BONE, root_slots(top))
+
+    return registry
+
+
+def get_registry(armature, top):
+    key = armature.as_pointer()
+
+    registry = REGISTRIES.get(key)
+
+    if registry is None:
+        registry = {}
+
+        for entry in top.registry:
+            if entry.object:
+                slots = registry.setdefault(entry.bone, {})
+                slots[entry.slot] = entry.object.name
+
+        REGISTRIES[key] = registry
+
+    return registry
+
+
+def clear_registry(armature):
+    REGISTRIES.pop(armature.as_pointer(), None)
+
+
+# The objects which are saved in the registry for the bone
+def registry_objects(armature, top, bone_name):
+    if bone_name == ROOT_BONE:
+        if top.root_body:
+            yield ('ROOT', top.root_body)
+
+    else:
+        bone = armature.data.bones.get(bone_name)
+
+        if bone is not None:
+            yield from bone_objects(bone.rigid_body_bones)
+
+
+# Returns the names of the bones which have different slots
+def changed_registry_bones(old_registry, new_registry):
+    return set(
+        bone_name
+        for bone_name in old_registry.keys() | new_registry.keys()
+        if old_registry.get(bone_name) != new_registry.get(bone_name)
+    )
+
+
+# This only rewrites the entries of the changed bones, and it gets the objects
+# from the bones, so it doesn't need to look up the objects by name
+def save_registry(armature, top, registry, changed):
+    REGISTRIES[armature.as_pointer()] = registry
+
+    entries = top.registry
+
+    # This is in reverse order so that removing an entry doesn't change the index of the next entries
+    for index in reversed(range(len(entries))):
+        if entries[index].bone in changed:
+            entries.remove(index)
+
+    for bone_name in changed:
+        for (slot, object) in registry_objects(armature, top, bone_name):
+            entry = entries.add()
+            entry.bone = bone_name
+            entry.slot = slot
+            entry.object = object
 
 
 def add_error(top, name):
@@ -30,6 +260,14 @@ def add_error(top, name):
     error.name = name
 
 
+def remove_errors(top, names):
+    errors = top.errors
+
+    for index in reversed(range(len(errors))):
+        if errors[index].name in names:
+            errors.remove(index)
+
+
 def root_collection(context):
     scene = context.scene
 
@@ -160,14 +398,65 @@ def joints_collection(context, armature, top):
     return collection
 
 
+# If exists is None then it only removes the collection if it is empty
 def remove_orphans(collection, exists):
-    for object in collection.objects:
-        if object.name not in exists:
-            utils.remove_object(object)
+    if exists is not None:
+        for object in collection.objects:
+            if object.name not in exists:
+                utils.remove_object(object)
 
     return utils.safe_remove_collection(collection)
 
 
+# Returns the armature's action and the actions of its NLA strips, without duplicates
+def armature_actions(armature):
+    actions = []
+
+    if armature.animation_data:
+        seen = set()
+
+        def add(action):
+            if action and action.name not in seen:
+                seen.add(action.name)
+                actions.append(action)
+
+        add(armature.animation_data.action)
+
+        for track in armature.animation_data.nla_tracks:
+            for strip in track.strips:
+                add(strip.action)
+
+    return actions
+
+
+# The actions can be shared with other armatures, so this skips the actions which
+# are used by an armature which still mutes fcurves instead of using override mode
+def unmute_fcurves(armature):
+    shared = set()
+
+    for object in bpy.data.objects:
+        if object.type == 'ARMATURE' and object != armature:
+            top = object.data.rigid_body_bones
+
+            if top.enabled and not top.override_keyframes:
+                for action in armature_actions(object):
+                    shared.add(action.name)
+
+    should_mute = {pose_bone.name: False for pose_bone in armature.pose.bones}
+
+    for action in armature_actions(armature):
+        if action.name not in shared:
+            utils.mute_fcurves(action, should_mute)
+
+
+def has_collection_orphans(collection, exists):
+    for sub in collection.children:
+        if sub.name not in exists:
+            return True
+
+    return len(collection.children) == 0 and len(collection.objects) == 0
+
+
 def remove_collection_orphans(collection, exists):
     for sub in collection.children:
         if sub.name not in exists:
@@ -190,6 +479,27 @@ class Update(bpy.types.Operator):
     # TODO use UNDO_GROUPED ?
     bl_options = {'INTERNAL', 'UNDO'}
 
+    full: bpy.props.BoolProperty(
+        name="Full Update",
+        description="Reconcile every bone, rather than only the bones which have changed",
+        default=False,
+        options={'SKIP_SAVE'},
+    )
+
+    file_loaded: bpy.props.BoolProperty(
+        name="File Loaded",
+        description="Skip the Update if the bones haven't changed since the file was saved",
+        default=False,
+        options={'SKIP_SAVE'},
+    )
+
+    mode_switch: bpy.props.BoolProperty(
+        name="Mode Switch",
+        description="Only update what is different between the old and new mode",
+        default=False,
+        options={'SKIP_SAVE'},
+    )
+
 
     def fix_duplicates(self, data):
         duplicates = self.duplicates
@@ -241,29 +551,33 @@ class Update(bpy.types.Operator):
                     duplicates.add(name)
 
 
-    # TODO non-recursive version ?
-    def is_active_parent(self, bone):
-        if bone is None:
-            return False
+    def is_active_parent(self, name):
+        chain = []
+        is_active = False
 
-        else:
-            is_active = self.active_cache.get(bone.name)
+        # Walks up the hierarchy until it finds a bone which is already cached
+        while name is not None:
+            cached = self.active_cache.get(name)
 
-            if is_active is not None:
-                return is_active
+            if cached is not None:
+                is_active = cached
+                break
 
-            else:
-                data = bone.rigid_body_bones
+            data = self.bone_datas[name]
 
-                # Cannot use is_bone_enabled
-                if data.enabled and is_bone_active(data):
-                    self.active_cache[bone.name] = True
-                    return True
+            # Cannot use is_bone_enabled
+            if data.enabled and is_bone_active(data):
+                is_active = True
+                self.active_cache[name] = True
+                break
 
-                else:
-                    is_active = self.is_active_parent(bone.parent)
-                    self.active_cache[bone.name] = is_active
-                    return is_active
+            chain.append(name)
+            name = self.parents[name]
+
+        for name in chain:
+            self.active_cache[name] = is_active
+
+        return is_active
 
 
     def update_error(self, top, bone, data):
@@ -273,7 +587,7 @@ class Update(bpy.types.Operator):
             data.property_unset("error")
 
         else:
-            is_active = self.is_active_parent(bone.parent)
+            is_active = self.is_active_parent(self.parents[bone.name])
             self.active_cache[bone.name] = is_active
 
             if is_active:
@@ -290,15 +604,15 @@ class Update(bpy.types.Operator):
             assert data.is_property_set("name")
             assert data.is_property_set("use_connect")
 
-            self.names[data.name] = bone.name
+            # Can't use is_bone_enabled because this runs before update_error
+            should_remove = top.enabled and self.is_active and data.enabled and is_bone_active(data)
 
             if bone.parent is None:
-                if data.parent != "":
+                if data.parent != "" and not should_remove:
                     self.restore_parent[bone.name] = (data.parent, data.use_connect)
 
             else:
-                # Can't use is_bone_enabled because this runs before update_error
-                if top.enabled and self.is_active and data.enabled and is_bone_active(data):
+                if should_remove:
                     self.remove_parent.add(bone.name)
 
 
@@ -330,17 +644,9 @@ class Update(bpy.types.Operator):
         return root
 
 
-    def make_origin(self, context, armature, top, data, parent, name):
+    def make_origin(self, data, parent):
         origin = data.origin_empty
 
-        if not origin:
-            collection = origins_collection(context, armature, top)
-            origin = make_origin(collection, name)
-            data.origin_empty = origin
-
-        else:
-            origin.name = name
-
         origin.empty_display_type = 'ARROWS'
 
         # TODO only set this if the parent is different ?
@@ -360,6 +666,10 @@ class Update(bpy.types.Operator):
         else:
             blank.name = blank_name(bone)
 
+        # The Blank is saved in the bone's properties, so the bone's registry and state must be saved
+        if not self.is_changed(bone):
+            self.targets.add(bone.name)
+
         self.exists.add(blank.name)
 
         return blank
@@ -402,16 +712,35 @@ class Update(bpy.types.Operator):
             return None
 
 
-    def make_compounds(self, context, armature, top, bone, data, parent):
-        if data.collision_shape == 'COMPOUND':
-            for compound in data.compounds:
-                if not compound.hitbox:
-                    collection = compounds_collection(context, armature, top)
-                    compound.hitbox = make_compound_hitbox(context, collection, bone, compound)
+    # Joints can be connected to a bone in a different armature, but it must not
+    # create any objects for the other armature, so it only uses the existing hitbox
+    def get_other_hitbox(self, data, target):
+        subtarget = data.subtarget
 
-                else:
-                    update_hitbox_name(compound.hitbox, compound_name(bone, compound))
+        if subtarget == "":
+            data.error = 'MISSING_BONE'
+            return None
+
+        target_bone = target.data.bones.get(subtarget, None)
 
+        if target_bone and target.data.rigid_body_bones.enabled:
+            hitbox = get_hitbox(target_bone.rigid_body_bones)
+
+        else:
+            hitbox = None
+
+        if hitbox is None:
+            data.error = 'INVALID_BONE'
+
+        else:
+            data.property_unset("error")
+
+        return hitbox
+
+
+    def make_compounds(self, data, parent):
+        if data.collision_shape == 'COMPOUND':
+            for compound in data.compounds:
                 assert parent is not None
 
                 # TODO only set this if the parent is different ?
@@ -419,102 +748,159 @@ class Update(bpy.types.Operator):
 
                 self.exists.add(compound.hitbox.name)
 
-                self.make_origin(context, armature, top, compound, compound.hitbox, compound_origin_name(bone, compound))
+                self.make_origin(compound, compound.hitbox)
 
-        else:
-            for compound in data.compounds:
-                remove_compound(compound)
 
+    def make_parent_joint(self, context, armature, top, pose_bone):
+        data = pose_bone.bone.rigid_body_bones
 
-    def make_parent_joints(self, context, armature, top, pose_bone, data):
         joint = self.make_joint(context, armature, top, data, joint_name(pose_bone.bone), False)
-        parent = pose_bone.parent
+        parent = self.parent_pose_bone(armature, pose_bone)
 
         if parent:
-            parent_data = parent.bone.rigid_body_bones
-
-            self.make_parent_joints(context, armature, top, parent, parent_data)
+            parent_joint = self.joints[parent.name]
 
-            assert parent_data.constraint is not None
-
-            utils.set_parent(joint, parent_data.constraint)
-            joint.matrix_basis = pose_bone.matrix
-            joint.matrix_parent_inverse = parent.matrix.inverted()
+            utils.set_parent(joint, parent_joint)
+            joint.matrix_basis = self.pose_matrix(armature, pose_bone)
+            joint.matrix_parent_inverse = self.pose_matrix(armature, parent).inverted()
 
         else:
             utils.set_parent(joint, armature)
-            joint.matrix_basis = pose_bone.matrix
+            joint.matrix_basis = self.pose_matrix(armature, pose_bone)
             joint.matrix_parent_inverse = Matrix.Identity(4)
 
-        return joint
+        self.joints[pose_bone.name] = joint
 
 
-    def update_bone(self, context, armature, top, pose_bone, bone, data):
+    # Makes the joints for the bone and all of its ancestors.
+    #
+    # Each joint is only made once per update, so this is linear even with
+    # very long chains of bones.
+    def make_parent_joints(self, context, armature, top, pose_bone, data):
+        name = pose_bone.name
+        chain = []
+
+        while pose_bone is not None and pose_bone.name not in self.joints:
+            chain.append(pose_bone)
+            pose_bone = self.parent_pose_bone(armature, pose_bone)
+
+        # The ancestors must be made first, because they are the parents of the joints
+        for pose_bone in reversed(chain):
+            self.make_parent_joint(context, armature, top, pose_bone)
+
+        return self.joints[name]
+
+
+    # This decides which hitboxes, origins, and compounds the bone should have
+    def plan_bone(self, plan, top, bone, data):
         if top.enabled and is_bone_enabled(data):
             if is_bone_active(data):
-                remove_passive(data)
+                plan.remove(data, "passive")
+                plan.keep('ACTIVE', bone, data, "active", active_name(bone))
 
-                self.make_parent_joints(context, armature, top, pose_bone, data)
+            else:
+                plan.remove(data, "active")
+                plan.keep('PASSIVE', bone, data, "passive", passive_name(bone))
 
-                if not data.active:
-                    collection = actives_collection(context, armature, top)
-                    data.active = make_active_hitbox(context, armature, collection, bone, data)
+            plan.keep('ORIGIN', bone, data, "origin_empty", origin_name(bone))
 
-                else:
-                    update_hitbox_name(data.active, active_name(bone))
+            if data.collision_shape == 'COMPOUND':
+                for compound in data.compounds:
+                    plan.keep('COMPOUND', bone, compound, "hitbox", compound_name(bone, compound))
+                    plan.keep('ORIGIN', bone, compound, "origin_empty", compound_origin_name(bone, compound))
+
+            else:
+                for compound in data.compounds:
+                    plan.remove(compound, "hitbox")
+                    plan.remove(compound, "origin_empty")
+
+        else:
+            plan.remove(data, "active")
+            plan.remove(data, "passive")
+            plan.remove(data, "origin_empty")
+
+            for compound in data.compounds:
+                plan.remove(compound, "hitbox")
+                plan.remove(compound, "origin_empty")
 
-                self.make_compounds(context, armature, top, bone, data, data.active)
-                self.make_origin(context, armature, top, data, data.active, origin_name(bone))
 
-                align_origin(data.origin_empty, pose_bone, data)
+    # This creates, renames, and removes the objects in batches, grouped by kind
+    def apply_plan(self, context, armature, top, plan):
+        utils.debug(plan.summary())
 
-                align_hitbox(data.active, armature, pose_bone, data, self.is_active)
-                update_hitbox_shape(data.active, data)
-                update_rigid_body(data.active.rigid_body, data)
+        # Objects are removed first so that their names can be reused
+        for (owner, attribute) in plan.removes:
+            utils.remove_object(getattr(owner, attribute))
+            owner.property_unset(attribute)
 
-                self.exists.add(data.active.name)
+        for (object, name) in plan.renames:
+            if object.data is None:
+                object.name = name
 
             else:
-                remove_active(data)
+                update_hitbox_name(object, name)
 
-                if not data.passive:
-                    collection = passives_collection(context, armature, top)
-                    data.passive = make_passive_hitbox(context, armature, collection, bone, data)
+        slots = plan.creates['ACTIVE']
 
-                else:
-                    update_hitbox_name(data.passive, passive_name(bone))
+        if len(slots) > 0:
+            collection = actives_collection(context, armature, top)
 
-                self.make_compounds(context, armature, top, bone, data, data.passive)
-                self.make_origin(context, armature, top, data, data.passive, origin_name(bone))
+            plans.fill_slots(slots, make_active_hitboxes(context, armature, collection, [slot.name for slot in slots]))
 
-                align_origin(data.origin_empty, pose_bone, data)
+        slots = plan.creates['PASSIVE']
 
-                align_hitbox(data.passive, armature, pose_bone, data, False)
-                update_hitbox_shape(data.passive, data)
-                update_rigid_body(data.passive.rigid_body, data)
+        if len(slots) > 0:
+            collection = passives_collection(context, armature, top)
 
-                self.exists.add(data.passive.name)
+            plans.fill_slots(slots, make_passive_hitboxes(context, armature, collection, [slot.name for slot in slots], [slot.bone for slot in slots]))
 
-        else:
-            remove_active(data)
-            remove_passive(data)
-            remove_origin(data)
+        slots = plan.creates['COMPOUND']
 
-            for compound in data.compounds:
-                remove_compound(compound)
+        if len(slots) > 0:
+            collection = compounds_collection(context, armature, top)
 
+            plans.fill_slots(slots, make_compound_hitboxes(context, collection, [slot.name for slot in slots]))
 
-    def fix_parents(self, armature, top, bone, data):
-        if self.store_parents:
-            store_parent(bone, data)
+        slots = plan.creates['ORIGIN']
+
+        if len(slots) > 0:
+            collection = origins_collection(context, armature, top)
+
+            plans.fill_slots(slots, make_origins(collection, [slot.name for slot in slots]))
+
+
+    def update_bone(self, context, armature, top, pose_bone, bone, data):
+        if top.enabled and is_bone_enabled(data):
+            if is_bone_active(data):
+                self.make_parent_joints(context, armature, top, pose_bone, data)
+
+                hitbox = data.active
+                is_active = self.is_active
 
+            else:
+                hitbox = data.passive
+                is_active = False
+
+            self.make_compounds(data, hitbox)
+            self.make_origin(data, hitbox)
+
+            align_origin(data.origin_empty, pose_bone, data)
+
+            align_hitbox(hitbox, armature, pose_bone, data, is_active)
+            update_hitbox_shape(hitbox, data)
+            update_rigid_body(hitbox.rigid_body, data)
+
+            self.exists.add(hitbox.name)
+
+
+    def fix_parents(self, armature, top, bone, data):
         self.process_parent(armature, top, bone, data)
 
         if self.delete_parents:
             delete_parent(data)
 
 
-    def process_bone(self, context, armature, top, pose_bone):
+    def process_bone(self, top, pose_bone, plan):
         bone = pose_bone.bone
         data = bone.rigid_body_bones
 
@@ -524,15 +910,15 @@ class Update(bpy.types.Operator):
 
         self.hide_active(top, bone, data)
 
-        self.update_bone(context, armature, top, pose_bone, bone, data)
+        self.plan_bone(plan, top, bone, data)
 
 
-    def make_joints(self, context, armature, top, pose_bone, bone_data):
+    def make_joints(self, context, armature, top, pose_bone, bone_data, stack):
         bone = pose_bone.bone
 
         if len(bone_data.constraints) > 0:
             for data in bone_data.constraints:
-                data.create_joint_constraint(pose_bone)
+                data.create_joint_constraint(stack)
 
                 target = data.target
 
@@ -540,7 +926,6 @@ class Update(bpy.types.Operator):
                     data.property_unset("error")
 
                 elif target.type == 'ARMATURE':
-                    # TODO add in support for different armatures
                     if target == armature:
                         subtarget = data.subtarget
 
@@ -556,7 +941,6 @@ class Update(bpy.types.Operator):
                             target_bone = target.data.bones.get(subtarget, None)
 
                             if target_bone:
-                                # TODO this is wrong if the armature is different
                                 target = self.get_hitbox(context, target, target.data.rigid_body_bones, target_bone, target_bone.rigid_body_bones)
 
                                 if target is None:
@@ -570,8 +954,7 @@ class Update(bpy.types.Operator):
                                 target = None
 
                     else:
-                        data.error = 'DIFFERENT_ARMATURE'
-                        target = None
+                        target = self.get_other_hitbox(data, target)
 
                 else:
                     data.property_unset("error")
@@ -601,14 +984,14 @@ class Update(bpy.types.Operator):
                     constraint.object1 = target
                     constraint.object2 = self.get_hitbox(context, armature, top, bone, bone_data)
 
-            sort_constraints(pose_bone)
-
 
     def update_joint(self, context, armature, top, pose_bone):
         bone = pose_bone.bone
         data = bone.rigid_body_bones
 
-        self.make_joints(context, armature, top, pose_bone, data)
+        stack = self.constraint_stack(pose_bone)
+
+        self.make_joints(context, armature, top, pose_bone, data, stack)
 
         is_active = is_bone_enabled(data) and is_bone_active(data)
 
@@ -618,13 +1001,13 @@ class Update(bpy.types.Operator):
             update_joint_active(context, joint, is_active)
 
         if is_active:
-            create_pose_constraint(armature, pose_bone, data, self.is_active)
+            create_pose_constraint(stack, pose_bone, data, self.is_active, top.override_keyframes, self.inverses)
 
             constraint = joint.rigid_body_constraint
 
             update_joint_constraint(constraint, data)
 
-            parent = pose_bone.parent
+            parent = self.parent_pose_bone(armature, pose_bone)
 
             if parent:
                 parent_data = parent.bone.rigid_body_bones
@@ -636,42 +1019,50 @@ class Update(bpy.types.Operator):
             constraint.object2 = data.active
 
         else:
-            remove_pose_constraint(pose_bone, data)
+            remove_pose_constraint(stack, data)
+
+        # This is only done once per bone, after all of the constraints have been created
+        stack.sort()
 
 
     def update_joints(self, context, armature, top):
         if top.enabled:
+            # Child Of constraints which need a new inverse_matrix
+            self.inverses = []
+
             for pose_bone in armature.pose.bones:
-                self.update_joint(context, armature, top, pose_bone)
+                if self.is_changed(pose_bone.bone):
+                    self.update_joint(context, armature, top, pose_bone)
+
+            update_pose_inverses(self.inverses)
 
         else:
             for pose_bone in armature.pose.bones:
+                if not self.is_changed(pose_bone.bone):
+                    continue
+
                 data = pose_bone.bone.rigid_body_bones
 
-                remove_pose_constraint(pose_bone, data)
+                remove_pose_constraint(self.constraint_stack(pose_bone), data)
 
                 for joint in data.constraints:
                     remove_joint(joint)
 
 
-    def update_action(self, seen_actions, should_mute, action):
-        if action and not action.name in seen_actions:
-            seen_actions.add(action.name)
-
-            for fcurve in action.fcurves:
-                match = DATA_PATH_REGEXP.match(fcurve.data_path)
-
-                if match:
-                    name = match.group(1)
-                    mute = should_mute.get(name, None)
+    # This disables keyframe animations for Active bones
+    def update_fcurves(self, armature, top):
+        if top.override_keyframes:
+            # The override constraints disable the keyframes instead, so the fcurves
+            # only need to be unmuted once, when switching to override mode
+            if not top.fcurves_unmuted:
+                unmute_fcurves(armature)
+                top.fcurves_unmuted = True
 
-                    if mute is not None:
-                        fcurve.mute = mute
+            return
 
+        if top.fcurves_unmuted:
+            top.property_unset("fcurves_unmuted")
 
-    # This disables keyframe animations for Active bones
-    def update_fcurves(self, armature, top):
-        seen_actions = set()
         should_mute = {}
 
         is_active = top.enabled and self.is_active
@@ -681,12 +1072,8 @@ class Update(bpy.types.Operator):
             data = bone.rigid_body_bones
             should_mute[bone.name] = is_active and is_bone_enabled(data) and is_bone_active(data)
 
-        if armature.animation_data:
-            self.update_action(seen_actions, should_mute, armature.animation_data.action)
-
-            for track in armature.animation_data.nla_tracks:
-                for strip in track.strips:
-                    self.update_action(seen_actions, should_mute, strip.action)
+        for action in armature_actions(armature):
+            utils.mute_fcurves(action, should_mute)
 
 
     def restore_parents(self, armature):
@@ -738,25 +1125,34 @@ class Update(bpy.types.Operator):
         if top.root_body and not top.root_body.name in exists:
             remove_root_body(top)
 
-        if top.actives and remove_orphans(top.actives, exists):
+        # When only some of the bones changed, the registry is used to find their
+        # orphans, which is faster than searching every object in the collections
+        if self.bones is None:
+            checked = exists
+
+        else:
+            self.remove_registry_orphans(armature, top)
+            checked = None
+
+        if top.actives and remove_orphans(top.actives, checked):
             top.property_unset("actives")
 
-        if top.passives and remove_orphans(top.passives, exists):
+        if top.passives and remove_orphans(top.passives, checked):
             top.property_unset("passives")
 
-        if top.compounds and remove_orphans(top.compounds, exists):
+        if top.compounds and remove_orphans(top.compounds, checked):
             top.property_unset("compounds")
 
-        if top.origins and remove_orphans(top.origins, exists):
+        if top.origins and remove_orphans(top.origins, checked):
             top.property_unset("origins")
 
-        if top.blanks and remove_orphans(top.blanks, exists):
+        if top.blanks and remove_orphans(top.blanks, checked):
             top.property_unset("blanks")
 
-        if top.constraints and remove_orphans(top.constraints, exists):
+        if top.constraints and remove_orphans(top.constraints, checked):
             top.property_unset("constraints")
 
-        if top.container and remove_orphans(top.container, exists):
+        if top.container and remove_orphans(top.container, checked):
             top.property_unset("container")
 
 
@@ -766,93 +1162,602 @@ class Update(bpy.types.Operator):
             scene.property_unset("collection")
 
 
-    def process_edit(self, context, armature, top):
-        with utils.Mode(context, armature, 'POSE'):
-            for pose_bone in armature.pose.bones:
-                bone = pose_bone.bone
-                data = bone.rigid_body_bones
+    # The constraints of each bone are only indexed once per Update
+    def constraint_stack(self, pose_bone):
+        stack = self.stacks.get(pose_bone.name)
 
-                self.fix_parents(armature, top, bone, data)
+        if stack is None:
+            stack = ConstraintStack(pose_bone)
+            self.stacks[pose_bone.name] = stack
 
-                for joint in data.constraints:
-                    joint.create_joint_constraint(pose_bone)
+        return stack
 
-        self.restore_parents(armature)
 
-        if top.actives:
-            top.actives.hide_viewport = True
+    # When these change every bone needs to be reconciled
+    def settings(self, top):
+        return (top.enabled, top.hide_active_bones, top.override_keyframes, self.is_active)
 
-        if top.passives:
-            top.passives.hide_viewport = True
 
-        if top.compounds:
-            top.compounds.hide_viewport = True
+    def is_changed(self, bone):
+        return self.bones is None or bone.name in self.bones
 
-        if top.origins:
-            top.origins.hide_viewport = True
 
-        if top.blanks:
-            top.blanks.hide_viewport = True
+    # The registry and state are saved for the changed bones, and also for the joint targets which were given a Blank
+    def is_saved(self, bone):
+        return self.is_changed(bone) or bone.name in self.targets
 
-        if top.constraints:
-            top.constraints.hide_viewport = True
 
+    def parent_pose_bone(self, armature, pose_bone):
+        parent = self.parents[pose_bone.name]
 
-    def process_pose(self, context, armature, top):
-        top.errors.clear()
+        if parent is None:
+            return None
 
-        for pose_bone in armature.pose.bones:
-            bone = pose_bone.bone
-            data = bone.rigid_body_bones
-            # This is needed in order to avoid a cyclic dependency
-            mute_pose_constraint(pose_bone)
-            self.fix_parents(armature, top, bone, data)
+        else:
+            return armature.pose.bones[parent]
 
-        # This must happen before process_bone
-        with utils.Mode(context, armature, 'EDIT'):
-            self.restore_parents(armature)
 
-        for pose_bone in armature.pose.bones:
-            self.process_bone(context, armature, top, pose_bone)
+    # The parents of Active bones are removed, this returns the pose matrix
+    # of the bone as if its parents had not been removed, without needing
+    # to restore the parents in Edit mode.
+    def pose_matrix(self, armature, pose_bone):
+        matrix = self.matrices.get(pose_bone.name)
 
-        self.update_joints(context, armature, top)
+        if matrix is None:
+            chain = []
 
-        self.update_fcurves(armature, top)
+            while pose_bone is not None and pose_bone.name not in self.matrices:
+                chain.append(pose_bone)
+                pose_bone = self.parent_pose_bone(armature, pose_bone)
 
-        self.remove_orphans(context, armature, top)
+            # The ancestors are calculated first, because the children depend on them
+            for pose_bone in reversed(chain):
+                matrix = self.calculate_pose_matrix(armature, pose_bone)
+                self.matrices[pose_bone.name] = matrix
 
-        # This must happen after update_joints
-        if self.is_active:
-            with utils.Mode(context, armature, 'EDIT'):
-                self.remove_parents(armature)
+        return matrix
 
-        if top.actives:
-            top.actives.hide_viewport = self.is_object_mode or top.hide_hitboxes
 
-        if top.passives:
-            top.passives.hide_viewport = self.is_object_mode or top.hide_hitboxes
+    def calculate_pose_matrix(self, armature, pose_bone):
+        name = pose_bone.name
+        parent = self.parent_pose_bone(armature, pose_bone)
 
-        if top.compounds:
-            top.compounds.hide_viewport = self.is_object_mode or top.hide_hitboxes
+        if parent is None:
+            return pose_bone.matrix.copy()
 
-        if top.origins:
-            top.origins.hide_viewport = self.is_object_mode or top.hide_hitbox_origins
+        # The parent is removed, so this adds back the parent's transformation
+        elif pose_bone.parent is None:
+            self.moved.add(name)
 
-        if top.blanks:
-            top.blanks.hide_viewport = True
+            bone = pose_bone.bone
+            local = local_matrix(parent_transform(bone, None, None), pose_bone.matrix)
 
-        if top.constraints:
-            top.constraints.hide_viewport = self.is_object_mode or top.hide_constraints
+            # Connected bones can't be moved away from their parent
+            if bone.rigid_body_bones.use_connect:
+                local.translation = (0.0, 0.0, 0.0)
 
+            transform = parent_transform(bone, parent.bone, self.matrices[parent.name])
+            return apply_parent_transform(transform, local)
 
-    @classmethod
-    def poll(cls, context):
-        return utils.is_armature(context)
+        # The parent's matrix is different, so this replaces the parent's transformation
+        elif parent.name in self.moved:
+            self.moved.add(name)
 
+            bone = pose_bone.bone
+            local = local_matrix(parent_transform(bone, parent.bone, parent.matrix), pose_bone.matrix)
 
-    def execute(self, context):
-        armature = context.active_object
-        top = armature.data.rigid_body_bones
+            transform = parent_transform(bone, parent.bone, self.matrices[parent.name])
+            return apply_parent_transform(transform, local)
+
+        else:
+            return pose_bone.matrix.copy()
+
+
+    # Returns the name of the bone's parent, even if the parent has been removed
+    def parent_name(self, bone, data):
+        if bone.parent is not None:
+            return bone.parent.name
+
+        elif data.is_property_set("parent") and data.parent != "":
+            return self.names.get(data.parent)
+
+        else:
+            return None
+
+
+    # Returns the names of the bones which need to be reconciled, or None if
+    # every bone needs to be reconciled.
+    def changed_bones(self, armature, top):
+        settings = self.settings(top)
+
+        # Bones with joints connected to a different armature which changed
+        forced = utils.take_forced_bones(armature)
+
+        cached = BONE_STATES.get(armature.as_pointer())
+
+        # Switching between Object and Pose mode only changes whether the simulation is active,
+        # which only matters for the bones that are listed by depends_on_simulation
+        is_switched = (
+            cached is not None and
+            cached[0][:-1] == settings[:-1] and
+            cached[0][-1] != settings[-1]
+        )
+
+        if (
+            self.full or
+            self.store_parents or
+            self.delete_parents or
+            cached is None or
+            (cached[0] != settings and not is_switched)
+        ):
+            return None
+
+        old_states = cached[1]
+
+        parents = self.parents
+        children = {}
+        targeted_by = {}
+        changed = set()
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+            data = bone.rigid_body_bones
+            name = bone.name
+
+            parent = parents[name]
+
+            if parent is not None:
+                children.setdefault(parent, []).append(name)
+
+            for joint in data.constraints:
+                if joint.target == armature and joint.subtarget != "":
+                    targeted_by.setdefault(joint.subtarget, []).append(name)
+
+            old_state = old_states.get(name)
+
+            if old_state is None or old_state != bone_state(pose_bone):
+                changed.add(name)
+
+            elif is_switched and depends_on_simulation(data):
+                changed.add(name)
+
+        # Bones have been created, deleted, or renamed
+        if parents.keys() != old_states.keys():
+            return None
+
+        for name in forced:
+            if name in parents:
+                changed.add(name)
+
+        bones = set()
+
+        # The joints of the descendants depend on the bone,
+        # and so do the constraints which target the bone
+        pending = list(changed)
+
+        while len(pending) > 0:
+            name = pending.pop()
+
+            if name not in bones:
+                bones.add(name)
+                pending.extend(children.get(name, ()))
+                pending.extend(targeted_by.get(name, ()))
+
+        # The parents of the ancestors must be restored in order to calculate the joints
+        for name in list(bones):
+            parent = parents.get(name)
+
+            while parent is not None and parent not in bones:
+                bones.add(parent)
+                parent = parents.get(parent)
+
+        return bones
+
+
+    # Marks the objects of an unchanged bone as existing, so they aren't removed by remove_orphans
+    def keep_bone(self, bone, data):
+        exists = self.exists
+
+        if data.active:
+            exists.add(data.active.name)
+
+        if data.passive:
+            exists.add(data.passive.name)
+
+        if data.origin_empty:
+            exists.add(data.origin_empty.name)
+
+        for compound in data.compounds:
+            if compound.hitbox:
+                exists.add(compound.hitbox.name)
+
+            if compound.origin_empty:
+                exists.add(compound.origin_empty.name)
+
+        if data.constraint:
+            self.keep_joint(data.constraint)
+
+            # The joints of the ancestors are used as the parents for this joint
+            parent = self.parents.get(bone.name)
+
+            while parent is not None:
+                parent_data = self.bone_datas[parent]
+                joint = parent_data.constraint
+
+                if not joint or joint.name in exists:
+                    break
+
+                self.keep_joint(joint)
+                parent = self.parents.get(parent)
+
+        for joint in data.constraints:
+            if joint.constraint:
+                self.keep_joint(joint.constraint)
+
+
+    def keep_joint(self, joint):
+        exists = self.exists
+
+        exists.add(joint.name)
+
+        constraint = joint.rigid_body_constraint
+
+        # This keeps the Blanks and Root which the joint is connected to
+        if constraint:
+            if constraint.object1:
+                exists.add(constraint.object1.name)
+
+            if constraint.object2:
+                exists.add(constraint.object2.name)
+
+
+    def remove_registry_orphans(self, armature, top):
+        registry = get_registry(armature, top)
+
+        collections = [top.actives, top.passives, top.compounds, top.origins, top.blanks, top.constraints, top.container]
+
+        for bone_name in self.bones:
+            slots = registry.get(bone_name)
+
+            if slots:
+                for name in slots.values():
+                    if name not in self.exists:
+                        # Only objects in this armature's collections are removed, just in case
+                        # the name is now used by a different object
+                        for collection in collections:
+                            if collection:
+                                object = collection.objects.get(name)
+
+                                if object:
+                                    utils.remove_object(object)
+                                    break
+
+
+    def update_registry(self, armature, top):
+        registry = get_registry(armature, top)
+
+        if self.bones is None:
+            new_registry = build_registry(armature, top)
+
+        else:
+            new_registry = dict(registry)
+
+            for bone in armature.data.bones:
+                if self.is_saved(bone):
+                    set_registry_slots(new_registry, bone.name, bone_slots(bone.rigid_body_bones))
+
+            set_registry_slots(new_registry, ROOT_BONE, root_slots(top))
+
+        # The registry is only saved if it changed, so that it doesn't write ID data every Update
+        if new_registry != registry:
+            changed = changed_registry_bones(registry, new_registry)
+
+            save_registry(armature, top, new_registry, changed)
+
+        else:
+            changed = set()
+
+        # A full update can recreate objects with the same names, so every joint in other armatures is updated
+        if self.bones is None:
+            utils.notify_dependents(armature, None)
+
+        # The joints in other armatures only need to change if the objects were created / removed / renamed
+        elif len(changed) > 0:
+            utils.notify_dependents(armature, changed)
+
+
+    def save_states(self, armature, top):
+        key = armature.as_pointer()
+        settings = self.settings(top)
+
+        cached = BONE_STATES.get(key)
+
+        if self.bones is None or cached is None:
+            states = {}
+        else:
+            states = cached[1]
+
+        for pose_bone in armature.pose.bones:
+            if self.is_saved(pose_bone.bone):
+                states[pose_bone.name] = bone_state(pose_bone)
+
+        BONE_STATES[key] = (settings, states)
+
+        cached = BONE_DIGESTS.get(key)
+
+        if self.bones is None or cached is None:
+            digests = bone_digests(states)
+            total = combine_digests(digests)
+
+        else:
+            (total, digests) = cached
+
+            # Only the changed bones are hashed
+            for name in self.bones | self.targets:
+                state = states.get(name)
+
+                if state is not None:
+                    old_digest = digests.get(name)
+
+                    if old_digest is not None:
+                        total ^= old_digest
+
+                    new_digest = digest((name, state))
+                    digests[name] = new_digest
+                    total ^= new_digest
+
+        BONE_DIGESTS[key] = (total, digests)
+
+        utils.set_property(top, "fingerprint", make_fingerprint(settings, total))
+
+        utils.set_property(top, "schema_version", utils.SCHEMA_VERSION)
+
+
+    def process_edit(self, context, armature, top):
+        with utils.Mode(context, armature, 'POSE'):
+            for pose_bone in armature.pose.bones:
+                bone = pose_bone.bone
+                data = bone.rigid_body_bones
+
+                if data.is_property_set("name"):
+                    self.names[data.name] = bone.name
+
+                self.fix_parents(armature, top, bone, data)
+
+                if len(data.constraints) > 0:
+                    stack = ConstraintStack(pose_bone)
+
+                    for joint in data.constraints:
+                        joint.create_joint_constraint(stack)
+
+        self.restore_parents(armature)
+
+        # Bones can be created, deleted, or renamed in Edit mode
+        clear_bone_states(armature)
+
+        # Blender changes the fcurve paths when a bone is renamed, and renaming in Edit mode doesn't send a rename event
+        for action in armature_actions(armature):
+            utils.invalidate_fcurve_index(action)
+        clear_registry(armature)
+        top.property_unset("fingerprint")
+
+        if top.actives:
+            top.actives.hide_viewport = True
+
+        if top.passives:
+            top.passives.hide_viewport = True
+
+        if top.compounds:
+            top.compounds.hide_viewport = True
+
+        if top.origins:
+            top.origins.hide_viewport = True
+
+        if top.blanks:
+            top.blanks.hide_viewport = True
+
+        if top.constraints:
+            top.constraints.hide_viewport = True
+
+
+    def process_pose(self, context, armature, top):
+        self.bone_datas = {}
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+            data = bone.rigid_body_bones
+
+            self.bone_datas[bone.name] = data
+
+            if self.store_parents:
+                store_parent(bone, data)
+
+            if data.is_property_set("name"):
+                self.names[data.name] = bone.name
+
+        # Bone name -> parent bone name, this uses the stored parents because
+        # the parents of Active bones are removed
+        self.parents = {}
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+            self.parents[bone.name] = self.parent_name(bone, self.bone_datas[bone.name])
+
+        # Pose matrices of the bones with their parents restored
+        self.matrices = {}
+        self.moved = set()
+
+        # Joints which have already been made during this update
+        self.joints = {}
+
+        # Bone name -> ConstraintStack
+        self.stacks = {}
+
+        # Names of the unchanged bones which were given a Blank by the joints of the changed bones
+        self.targets = set()
+
+        # Names of the bones which should be reconciled, or None for every bone
+        self.bones = self.changed_bones(armature, top)
+
+        utils.debug("CHANGED BONES {}".format(self.bones))
+
+        if self.bones is None:
+            top.errors.clear()
+
+        else:
+            remove_errors(top, self.bones)
+
+        is_muted = False
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+
+            if self.is_changed(bone):
+                data = bone.rigid_body_bones
+                # This is needed in order to avoid a cyclic dependency
+                if mute_pose_constraint(self.constraint_stack(pose_bone)):
+                    is_muted = True
+
+                self.fix_parents(armature, top, bone, data)
+
+        # This must happen before process_bone, so that the pose matrices are up to date
+        if is_muted:
+            context.view_layer.update()
+
+        plan = plans.Plan()
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+
+            if self.is_changed(bone):
+                self.process_bone(top, pose_bone, plan)
+
+        self.apply_plan(context, armature, top, plan)
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+
+            if self.is_changed(bone):
+                self.update_bone(context, armature, top, pose_bone, bone, bone.rigid_body_bones)
+
+        self.update_joints(context, armature, top)
+
+        utils.update_dependents(armature, self.bones)
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+
+            if not self.is_changed(bone):
+                self.keep_bone(bone, bone.rigid_body_bones)
+
+        self.update_fcurves(armature, top)
+
+        self.remove_orphans(context, armature, top)
+
+        # This must happen after update_joints
+        #
+        # All of the parent changes are done in a single trip to Edit mode
+        if len(self.restore_parent) > 0 or len(self.remove_parent) > 0:
+            with utils.Mode(context, armature, 'EDIT'):
+                self.restore_parents(armature)
+                self.remove_parents(armature)
+
+        self.save_states(armature, top)
+
+        self.update_registry(armature, top)
+
+        self.update_visibility(top)
+
+
+    def update_visibility(self, top):
+        if top.actives:
+            top.actives.hide_viewport = self.is_object_mode or top.hide_hitboxes
+
+        if top.passives:
+            top.passives.hide_viewport = self.is_object_mode or top.hide_hitboxes
+
+        if top.compounds:
+            top.compounds.hide_viewport = self.is_object_mode or top.hide_hitboxes
+
+        if top.origins:
+            top.origins.hide_viewport = self.is_object_mode or top.hide_hitbox_origins
+
+        if top.blanks:
+            top.blanks.hide_viewport = True
+
+        if top.constraints:
+            top.constraints.hide_viewport = self.is_object_mode or top.hide_constraints
+
+
+    def is_unchanged_file(self, context, armature, top):
+        if armature.mode == 'EDIT' or top.schema_version != utils.SCHEMA_VERSION or top.fingerprint == "":
+            return False
+
+        settings = self.settings(top)
+
+        if self.is_active:
+            with utils.AnimationFrame(context, armature):
+                states = all_bone_states(armature)
+
+        else:
+            states = all_bone_states(armature)
+
+        digests = bone_digests(states)
+        total = combine_digests(digests)
+
+        if make_fingerprint(settings, total) != top.fingerprint:
+            return False
+
+        # The bones are the same as the last Update, so the next Update only needs to reconcile the bones which change
+        BONE_STATES[armature.as_pointer()] = (settings, states)
+        BONE_DIGESTS[armature.as_pointer()] = (total, digests)
+        utils.update_dependents(armature, None)
+        return True
+
+
+    def is_unchanged_mode(self, armature, top):
+        if armature.mode == 'EDIT' or not top.enabled or not top.parents_stored:
+            return False
+
+        cached = BONE_STATES.get(armature.as_pointer())
+
+        return (
+            cached is not None and
+            cached[0] == self.settings(top) and
+            not self.has_changed_bones(armature, cached[1])
+        )
+
+
+    # Pose changes and some bone edits don't have update callbacks, so this
+    # diffs the bones the same way as changed_bones, but it stops at the first change
+    def has_changed_bones(self, armature, old_states):
+        if armature.as_pointer() in utils.FORCED_BONES:
+            return True
+
+        pose_bones = armature.pose.bones
+
+        if len(pose_bones) != len(old_states):
+            return True
+
+        for pose_bone in pose_bones:
+            old_state = old_states.get(pose_bone.name)
+
+            if old_state is None or old_state != bone_state(pose_bone):
+                return True
+
+        return False
+
+
+    @classmethod
+    def poll(cls, context):
+        return utils.is_armature(context)
+
+
+    def execute(self, context):
+        armature = context.active_object
+        top = armature.data.rigid_body_bones
+
+        utils.reset_writes()
 
 
         # Fast lookup for stored bone names -> new name
@@ -876,6 +1781,25 @@ class Update(bpy.types.Operator):
         self.is_active = self.is_object_mode or (armature.mode == 'POSE' and top.run_simulation)
 
 
+        # When switching between Object and Pose mode with the simulation running,
+        # the only difference is the visibility of the collections
+        if self.mode_switch and self.is_unchanged_mode(armature, top):
+            utils.debug("MODE SWITCH FAST PATH")
+            self.update_visibility(top)
+            UNDO_FINGERPRINTS[armature.name] = top.fingerprint
+            return {'FINISHED'}
+
+        if self.file_loaded and self.is_unchanged_file(context, armature, top):
+            utils.debug("FILE LOADED FAST PATH")
+            UNDO_FINGERPRINTS[armature.name] = top.fingerprint
+            return {'FINISHED'}
+
+        # Files which were saved with an older version of the add-on are fully rebuilt
+        if top.schema_version != utils.SCHEMA_VERSION:
+            utils.debug("MIGRATING {} -> {}".format(top.schema_version, utils.SCHEMA_VERSION))
+            self.full = True
+
+
         if is_edit_mode or not top.enabled:
             if top.parents_stored:
                 top.property_unset("parents_stored")
@@ -901,11 +1825,190 @@ class Update(bpy.types.Operator):
             self.active_cache = {}
 
             if self.is_active:
-                with utils.AnimationFrame(context):
+                with utils.AnimationFrame(context, armature):
                     self.process_pose(context, armature, top)
             else:
                 self.process_pose(context, armature, top)
 
+        UNDO_FINGERPRINTS[armature.name] = top.fingerprint
+
+        utils.print_writes()
+
+        return {'FINISHED'}
+
+
+def enabled_armatures(context):
+    return [
+        object for object in context.view_layer.objects
+        if object.type == 'ARMATURE' and object.data.rigid_body_bones.enabled
+    ]
+
+
+# Updates many armatures at once, it returns a list of (armature name, seconds)
+def update_armatures(context, armatures, full=False):
+    timings = []
+
+    with utils.Selected(context), utils.Selectable(context), utils.SceneFrame(context, armatures):
+        for armature in armatures:
+            utils.select_active(context, armature)
+            assert context.active_object.name == armature.name
+
+            time_start = time.time()
+
+            bpy.ops.rigid_body_bones.update(full=full)
+
+            time_end = time.time()
+
+            timings.append((armature.name, time_end - time_start))
+
+    return timings
+
+
+class UpdateAll(bpy.types.Operator):
+    bl_idname = "rigid_body_bones.update_all"
+    bl_label = "Update All Armatures"
+    bl_description = "Updates the rigid bodies of every enabled armature in the scene"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    full: bpy.props.BoolProperty(
+        name="Full Update",
+        description="Reconcile every bone, rather than only the bones which have changed",
+        default=False,
+    )
+
+
+    @classmethod
+    def poll(cls, context):
+        return context.active_object is None or context.active_object.mode != 'EDIT'
+
+
+    def execute(self, context):
+        armatures = enabled_armatures(context)
+
+        if len(armatures) == 0:
+            self.report({'INFO'}, "No armatures to update")
+            return {'CANCELLED'}
+
+        timings = update_armatures(context, armatures, full=self.full)
+
+        total = 0.0
+
+        for (name, seconds) in timings:
+            total += seconds
+            self.report({'INFO'}, "{}: {:.2f} ms".format(name, seconds * 1000.0))
+
+        self.report({'INFO'}, "Updated {} armatures in {:.2f} ms".format(len(timings), total * 1000.0))
+
+        return {'FINISHED'}
+
+
+# This only changes the names, it is much faster than Update when renaming bones
+class Rename(bpy.types.Operator):
+    bl_idname = "rigid_body_bones.rename"
+    bl_label = "Rename Rigid Body Bones"
+    bl_options = {'INTERNAL', 'UNDO'}
+
+
+    @classmethod
+    def poll(cls, context):
+        return utils.is_armature(context)
+
+
+    def rename_objects(self, pose_bone, bone, data):
+        if data.active:
+            update_hitbox_name(data.active, active_name(bone))
+
+        if data.passive:
+            update_hitbox_name(data.passive, passive_name(bone))
+
+        if data.origin_empty:
+            utils.set_property(data.origin_empty, "name", origin_name(bone))
+
+        if data.blank:
+            utils.set_property(data.blank, "name", blank_name(bone))
+
+        if data.constraint:
+            utils.set_property(data.constraint, "name", joint_name(bone))
+
+        for compound in data.compounds:
+            if compound.hitbox:
+                update_hitbox_name(compound.hitbox, compound_name(bone, compound))
+
+            if compound.origin_empty:
+                utils.set_property(compound.origin_empty, "name", compound_origin_name(bone, compound))
+
+        for joint in data.constraints:
+            if joint.constraint:
+                utils.set_property(joint.constraint, "name", joint_name(bone, name=joint.name))
+
+            joint.rename_joint_constraint(pose_bone)
+
+
+    def execute(self, context):
+        armature = context.active_object
+        top = armature.data.rigid_body_bones
+
+        utils.reset_writes()
+
+        # Old bone name -> new bone name
+        names = {}
+
+        for bone in armature.data.bones:
+            data = bone.rigid_body_bones
+
+            if data.is_property_set("name") and data.name != bone.name:
+                names[data.name] = bone.name
+
+        utils.debug("RENAMED BONES {}".format(names))
+
+        for pose_bone in armature.pose.bones:
+            bone = pose_bone.bone
+            data = bone.rigid_body_bones
+
+            if len(names) > 0:
+                if data.is_property_set("name"):
+                    utils.set_property(data, "name", bone.name)
+
+                if data.is_property_set("parent") and data.parent in names:
+                    data.parent = names[data.parent]
+
+            self.rename_objects(pose_bone, bone, data)
+
+        if len(names) > 0:
+            for error in top.errors:
+                if error.name in names:
+                    error.name = names[error.name]
+
+            # The bones keep their old state, so that the next Update only reconciles the renamed bones
+            cached = BONE_STATES.get(armature.as_pointer())
+
+            if cached is not None:
+                states = cached[1]
+
+                renamed = {}
+
+                for (old_name, new_name) in names.items():
+                    state = states.pop(old_name, None)
+
+                    if state is not None:
+                        renamed[new_name] = state
+
+                states.update(renamed)
+
+            # The digests include the bone names, so they are recalculated by the next Update
+            BONE_DIGESTS.pop(armature.as_pointer(), None)
+
+        registry = build_registry(armature, top)
+        old_registry = get_registry(armature, top)
+
+        if registry != old_registry:
+            save_registry(armature, top, registry, changed_registry_bones(old_registry, registry))
+
+        # Blender changes the fcurve paths when a bone is renamed
+        if len(names) > 0:
+            utils.clear_fcurve_indexes()
+
+        utils.print_writes()
 
         return {'FINISHED'}
 
@@ -934,12 +2037,199 @@ class CleanupArmatures(bpy.types.Operator):
 
         scene = context.scene.rigid_body_bones
 
+        # This avoids creating an undo step when there's nothing to cleanup
+        if not has_collection_orphans(scene.collection, exists):
+            return {'CANCELLED'}
+
         if remove_collection_orphans(scene.collection, exists):
             scene.property_unset("collection")
 
         return {'FINISHED'}
 
 
+def object_names(collection):
+    if collection:
+        return {object.name for object in collection.objects}
+    else:
+        return set()
+
+
+def is_linked(object, names):
+    return object.name in names
+
+
+def is_linked_body(object, names):
+    return object.name in names and object.rigid_body is not None
+
+
+# Undo can leave pointers to objects which are no longer in the armature's collections,
+# this removes those pointers and returns True if anything was removed
+def unset_broken(data, name, names, check):
+    object = getattr(data, name)
+
+    if object and not check(object, names):
+        data.property_unset(name)
+        return True
+
+    else:
+        return False
+
+
+def repair_bone(data, names):
+    # This uses | instead of "or" so that every pointer is checked
+    broken = unset_broken(data, "active", names["actives"], is_linked_body)
+    broken |= unset_broken(data, "passive", names["passives"], is_linked_body)
+    broken |= unset_broken(data, "blank", names["blanks"], is_linked_body)
+    broken |= unset_broken(data, "origin_empty", names["origins"], is_linked)
+    broken |= unset_broken(data, "constraint", names["constraints"], is_linked)
+
+    for compound in data.compounds:
+        broken |= unset_broken(compound, "hitbox", names["compounds"], is_linked_body)
+        broken |= unset_broken(compound, "origin_empty", names["origins"], is_linked)
+
+    for joint in data.constraints:
+        broken |= unset_broken(joint, "constraint", names["constraints"], is_linked)
+
+    return broken
+
+
+# Checks the pointers of an armature, so that the next Update only reconciles the bones
+# which are broken, it returns True if the armature needs to be updated
+def repair_armature(armature, top):
+    names = {
+        "actives": object_names(top.actives),
+        "passives": object_names(top.passives),
+        "compounds": object_names(top.compounds),
+        "origins": object_names(top.origins),
+        "blanks": object_names(top.blanks),
+        "constraints": object_names(top.constraints),
+    }
+
+    broken = []
+
+    for bone in armature.data.bones:
+        if repair_bone(bone.rigid_body_bones, names):
+            broken.append(bone.name)
+
+    # The root is used by every joint, so it needs a full update
+    is_root_broken = unset_broken(top, "root_body", names["blanks"], is_linked_body)
+
+    # The registry index might not match the registry which was restored by undo
+    clear_registry(armature)
+
+    if is_root_broken:
+        clear_bone_states(armature)
+
+    else:
+        cached = BONE_STATES.get(armature.as_pointer())
+
+        if cached is not None:
+            for name in broken:
+                cached[1].pop(name, None)
+
+    if is_root_broken or len(broken) > 0:
+        utils.debug("BROKEN BONES {} {}".format(armature.name, broken))
+        return True
+
+    else:
+        return False
+
+
+# Armature name -> fingerprint after the last Update, this is used after undo / redo
+# to skip the armatures which weren't changed by the undo step
+UNDO_FINGERPRINTS = {}
+
+
+# This runs after undo / redo, it doesn't push an undo step because that would break redo
+class RepairUndo(bpy.types.Operator):
+    bl_idname = "rigid_body_bones.repair_undo"
+    bl_label = "Repair Rigid Body Bones"
+    bl_options = {'INTERNAL'}
+
+
+    def execute(self, context):
+        broken = []
+
+        for object in context.view_layer.objects:
+            if object.type == 'ARMATURE':
+                top = object.data.rigid_body_bones
+
+                if top.enabled and top.container and object.mode != 'EDIT':
+                    # The fingerprint is saved in the armature, so if it is the same then the undo step didn't change the armature
+                    if UNDO_FINGERPRINTS.get(object.name) != top.fingerprint:
+                        UNDO_FINGERPRINTS[object.name] = top.fingerprint
+
+                        if repair_armature(object, top):
+                            broken.append(object)
+
+        if len(broken) > 0:
+            with utils.Selected(context), utils.Selectable(context):
+                for armature in broken:
+                    utils.select_active(context, armature)
+                    assert context.active_object.name == armature.name
+
+                    # This doesn't push an undo step, because that would remove the redo steps
+                    bpy.ops.rigid_body_bones.update('EXEC_DEFAULT', False)
+
+        return {'FINISHED'}
+
+
+class VerifyArmature(bpy.types.Operator):
+    bl_idname = "rigid_body_bones.verify_armature"
+    bl_label = "Verify and Repair"
+    bl_description = "Checks that the rigid body objects match the bones, and rebuilds them if they don't"
+    bl_options = {'REGISTER', 'UNDO'}
+
+
+    @classmethod
+    def poll(cls, context):
+        return utils.is_armature(context) and context.active_object.mode != 'EDIT'
+
+
+    def execute(self, context):
+        armature = context.active_object
+        top = armature.data.rigid_body_bones
+
+        # The registry is reloaded from the file, in case the index is wrong
+        clear_registry(armature)
+        registry = get_registry(armature, top)
+
+        expected = build_registry(armature, top)
+
+        problems = 0
+        owned = set()
+
+        for (bone_name, slots) in expected.items():
+            owned.update(slots.values())
+
+            if registry.get(bone_name) != slots:
+                problems += 1
+
+        # Bones which were deleted
+        for bone_name in registry.keys():
+            if bone_name not in expected:
+                problems += 1
+
+        # Objects in the collections which don't belong to any bone
+        for collection in [top.actives, top.passives, top.compounds, top.origins, top.blanks, top.constraints, top.container]:
+            if collection:
+                for object in collection.objects:
+                    if object.name not in owned:
+                        problems += 1
+
+        if problems == 0:
+            self.report({'INFO'}, "No problems found")
+            return {'CANCELLED'}
+
+        else:
+            clear_bone_states(armature)
+            clear_registry(armature)
+            bpy.ops.rigid_body_bones.update(full=True)
+
+            self.report({'INFO'}, "Repaired {} problems".format(problems))
+            return {'FINISHED'}
+
+
 class CopyFromActive(bpy.types.Operator):
     bl_idname = "rigid_body_bones.copy_from_active"
     bl_label = "Copy from Active"
@@ -1,7 +1,9 @@
 import bpy
-from math import radians
-from mathutils import Vector, Euler
+from math import radians, sqrt, acos, sin, cos, pi
+from bisect import bisect_left
+from mathutils import Vector, Euler, Matrix
 from . import utils
+from . import geometry
 
 
 def is_bone_enabled(data):
@@ -58,75 +60,68 @@ def shape_icon(shape):
 
 
 
-def common_settings(object):
-    object.hide_render = True
-    object.show_in_front = True
-    object.display.show_shadows = False
+COMMON_SETTINGS = (
+    ("hide_render", True),
+    ("show_in_front", True),
+    ("display.show_shadows", False),
+)
 
+ORIGIN_SETTINGS = COMMON_SETTINGS + (
+    ("rotation_euler", (radians(-90.0), 0.0, 0.0)),
+)
 
-def make_active_hitbox(context, armature, collection, bone, data):
-    hitbox = utils.make_mesh_object(
-        name=active_name(bone),
-        collection=collection,
-    )
+JOINT_SETTINGS = (
+    ("rotation_mode", 'QUATERNION'),
+    ("hide_render", True),
+    ("hide_viewport", True),
+    ("empty_display_size", 0.0),
+)
 
-    utils.set_parent(hitbox, armature)
+EXTRA_JOINT_SETTINGS = COMMON_SETTINGS + (
+    ("empty_display_type", 'ARROWS'),
+)
 
-    utils.select_active(context, hitbox)
-    bpy.ops.rigidbody.object_add(type='ACTIVE')
 
-    common_settings(hitbox)
+# These make many hitboxes at once, the names and bones are in the same order
+def make_active_hitboxes(context, armature, collection, names):
+    hitboxes = utils.make_objects(names, collection, COMMON_SETTINGS)
 
-    return hitbox
+    for hitbox in hitboxes:
+        utils.set_parent(hitbox, armature)
 
+    utils.add_rigid_bodies(context, hitboxes, 'ACTIVE')
 
-def make_passive_hitbox(context, armature, collection, bone, data):
-    hitbox = utils.make_mesh_object(
-        name=passive_name(bone),
-        collection=collection,
-    )
+    return hitboxes
 
-    utils.set_bone_parent(hitbox, armature, bone.name)
 
-    utils.select_active(context, hitbox)
-    bpy.ops.rigidbody.object_add(type='PASSIVE')
+def make_passive_hitboxes(context, armature, collection, names, bones):
+    hitboxes = utils.make_objects(names, collection, COMMON_SETTINGS)
 
-    hitbox.rigid_body.kinematic = True
-    common_settings(hitbox)
+    for (hitbox, bone) in zip(hitboxes, bones):
+        utils.set_bone_parent(hitbox, armature, bone.name)
 
-    return hitbox
+    utils.add_rigid_bodies(context, hitboxes, 'PASSIVE')
 
+    for hitbox in hitboxes:
+        hitbox.rigid_body.kinematic = True
 
-def make_compound_hitbox(context, collection, bone, data):
-    hitbox = utils.make_mesh_object(
-        name=compound_name(bone, data),
-        collection=collection,
-    )
+    return hitboxes
 
-    utils.select_active(context, hitbox)
-    bpy.ops.rigidbody.object_add(type='PASSIVE')
 
-    common_settings(hitbox)
+def make_compound_hitboxes(context, collection, names):
+    hitboxes = utils.make_objects(names, collection, COMMON_SETTINGS)
 
-    return hitbox
+    utils.add_rigid_bodies(context, hitboxes, 'PASSIVE')
 
+    return hitboxes
 
-def make_origin(collection, name):
-    origin = bpy.data.objects.new(name=name, object_data=None)
-    collection.objects.link(origin)
 
-    origin.rotation_euler = (radians(-90.0), 0.0, 0.0)
-
-    common_settings(origin)
-
-    return origin
+def make_origins(collection, names):
+    return utils.make_objects(names, collection, ORIGIN_SETTINGS, is_mesh=False)
 
 
 def make_empty_rigid_body(context, name, collection, parent, parent_bone):
-    body = utils.make_mesh_object(
-        name=name,
-        collection=collection,
-    )
+    body = utils.make_mesh_object(name, collection, COMMON_SETTINGS)
 
     if parent_bone is None:
         utils.set_parent(body, parent)
@@ -134,13 +129,11 @@ def make_empty_rigid_body(context, name, collection, parent, parent_bone):
     else:
         utils.set_bone_parent(body, parent, parent_bone)
 
-    utils.select_active(context, body)
-    bpy.ops.rigidbody.object_add(type='PASSIVE')
+    utils.add_rigid_body(context, body, 'PASSIVE')
 
     body.rigid_body.kinematic = True
     body.rigid_body.collision_collections[0] = False
 
-    common_settings(body)
     update_shape(body, type='BOX')
 
     body.hide_viewport = True
@@ -162,43 +155,29 @@ def make_blank_rigid_body(context, armature, collection, bone, data):
 
 
 def make_joint(collection, name):
-    empty = bpy.data.objects.new(name=name, object_data=None)
-    collection.objects.link(empty)
-
-    empty.rotation_mode = 'QUATERNION'
-    empty.hide_render = True
-    empty.hide_viewport = True
-    empty.empty_display_size = 0.0
-
-    return empty
+    return utils.make_objects([name], collection, JOINT_SETTINGS, is_mesh=False)[0]
 
 
 def make_extra_joint(collection, name):
-    empty = bpy.data.objects.new(name=name, object_data=None)
-    collection.objects.link(empty)
-
-    common_settings(empty)
-    empty.empty_display_type = 'ARROWS'
-
-    return empty
+    return utils.make_objects([name], collection, EXTRA_JOINT_SETTINGS, is_mesh=False)[0]
 
 
 def update_shape(object, type):
-    object.rigid_body.collision_shape = type
+    utils.set_property(object.rigid_body, "collision_shape", type)
 
     if type == 'CONVEX_HULL' or type == 'MESH':
-        object.show_bounds = False
-        object.display_type = 'WIRE'
-        object.display_bounds_type = 'BOX'
+        utils.set_property(object, "show_bounds", False)
+        utils.set_property(object, "display_type", 'WIRE')
+        utils.set_property(object, "display_bounds_type", 'BOX')
 
     else:
-        object.show_bounds = True
-        object.display_type = 'BOUNDS'
+        utils.set_property(object, "show_bounds", True)
+        utils.set_property(object, "display_type", 'BOUNDS')
 
         if type == 'COMPOUND':
-            object.display_bounds_type = 'BOX'
+            utils.set_property(object, "display_bounds_type", 'BOX')
         else:
-            object.display_bounds_type = type
+            utils.set_property(object, "display_bounds_type", type)
 
 
 def update_hitbox_shape(object, data):
@@ -213,25 +192,25 @@ def update_hitbox_shape(object, data):
 
 
 def update_rigid_body(rigid_body, data):
-    rigid_body.mass = data.mass
-    rigid_body.friction = data.friction
-    rigid_body.restitution = data.restitution
-    rigid_body.linear_damping = data.linear_damping
-    rigid_body.angular_damping = data.angular_damping
-    rigid_body.use_margin = data.use_margin
-    rigid_body.collision_margin = data.collision_margin
-    rigid_body.collision_collections = data.collision_collections
-    rigid_body.use_deactivation = data.use_deactivation
-    rigid_body.use_start_deactivated = data.use_start_deactivated
-    rigid_body.deactivate_linear_velocity = data.deactivate_linear_velocity
-    rigid_body.deactivate_angular_velocity = data.deactivate_angular_velocity
+    utils.set_property(rigid_body, "mass", data.mass)
+    utils.set_property(rigid_body, "friction", data.friction)
+    utils.set_property(rigid_body, "restitution", data.restitution)
+    utils.set_property(rigid_body, "linear_damping", data.linear_damping)
+    utils.set_property(rigid_body, "angular_damping", data.angular_damping)
+    utils.set_property(rigid_body, "use_margin", data.use_margin)
+    utils.set_property(rigid_body, "collision_margin", data.collision_margin)
+    utils.set_property(rigid_body, "collision_collections", data.collision_collections)
+    utils.set_property(rigid_body, "use_deactivation", data.use_deactivation)
+    utils.set_property(rigid_body, "use_start_deactivated", data.use_start_deactivated)
+    utils.set_property(rigid_body, "deactivate_linear_velocity", data.deactivate_linear_velocity)
+    utils.set_property(rigid_body, "deactivate_angular_velocity", data.deactivate_angular_velocity)
 
     if data.collision_shape == 'COMPOUND':
         for compound in data.compounds:
             compound_body = compound.hitbox.rigid_body
 
-            compound_body.use_margin = compound.use_margin
-            compound_body.collision_margin = compound.collision_margin
+            utils.set_property(compound_body, "use_margin", compound.use_margin)
+            utils.set_property(compound_body, "collision_margin", compound.collision_margin)
 
 
 def is_spring(data):
@@ -257,13 +236,7 @@ def constraint_type(data):
 def update_joint_active(context, joint, is_active):
     if is_active:
         if not joint.rigid_body_constraint:
-            utils.select_active(context, joint)
-
-            if not context.scene.rigidbody_world:
-                bpy.ops.rigidbody.world_add()
-
-            with utils.Viewable(joint):
-                bpy.ops.rigidbody.constraint_add(type='FIXED')
+            utils.add_rigid_body_constraint(context, joint, 'FIXED')
 
     else:
         if joint.rigid_body_constraint:
@@ -274,74 +247,65 @@ def update_joint_active(context, joint, is_active):
 
 
 def update_joint_constraint(constraint, data):
-    constraint.type = constraint_type(data)
-
-    constraint.disable_collisions = data.disable_collisions
-    constraint.use_breaking = data.use_breaking
-    constraint.breaking_threshold = data.breaking_threshold
-    constraint.use_override_solver_iterations = data.use_override_solver_iterations
-    constraint.solver_iterations = data.solver_iterations
-
-    constraint.use_spring_ang_x = data.use_spring_ang_x
-    constraint.use_spring_ang_y = data.use_spring_ang_y
-    constraint.use_spring_ang_z = data.use_spring_ang_z
-    constraint.spring_stiffness_ang_x = data.spring_stiffness_ang_x
-    constraint.spring_stiffness_ang_y = data.spring_stiffness_ang_y
-    constraint.spring_stiffness_ang_z = data.spring_stiffness_ang_z
-    constraint.spring_damping_ang_x = data.spring_damping_ang_x
-    constraint.spring_damping_ang_y = data.spring_damping_ang_y
-    constraint.spring_damping_ang_z = data.spring_damping_ang_z
-
-    constraint.use_spring_x = data.use_spring_x
-    constraint.use_spring_y = data.use_spring_y
-    constraint.use_spring_z = data.use_spring_z
-    constraint.spring_stiffness_x = data.spring_stiffness_x
-    constraint.spring_stiffness_y = data.spring_stiffness_y
-    constraint.spring_stiffness_z = data.spring_stiffness_z
-    constraint.spring_damping_x = data.spring_damping_x
-    constraint.spring_damping_y = data.spring_damping_y
-    constraint.spring_damping_z = data.spring_damping_z
-
-    constraint.use_limit_lin_x = data.use_limit_lin_x
-    constraint.use_limit_lin_y = data.use_limit_lin_y
-    constraint.use_limit_lin_z = data.use_limit_lin_z
-    constraint.use_limit_ang_x = data.use_limit_ang_x
-    constraint.use_limit_ang_y = data.use_limit_ang_y
-    constraint.use_limit_ang_z = data.use_limit_ang_z
-
-    constraint.limit_lin_x_lower = data.limit_lin_x_lower
-    constraint.limit_lin_y_lower = data.limit_lin_y_lower
-    constraint.limit_lin_z_lower = data.limit_lin_z_lower
-    constraint.limit_lin_x_upper = data.limit_lin_x_upper
-    constraint.limit_lin_y_upper = data.limit_lin_y_upper
-    constraint.limit_lin_z_upper = data.limit_lin_z_upper
+    utils.set_property(constraint, "type", constraint_type(data))
+
+    utils.set_property(constraint, "disable_collisions", data.disable_collisions)
+    utils.set_property(constraint, "use_breaking", data.use_breaking)
+    utils.set_property(constraint, "breaking_threshold", data.breaking_threshold)
+    utils.set_property(constraint, "use_override_solver_iterations", data.use_override_solver_iterations)
+    utils.set_property(constraint, "solver_iterations", data.solver_iterations)
+
+    utils.set_property(constraint, "use_spring_ang_x", data.use_spring_ang_x)
+    utils.set_property(constraint, "use_spring_ang_y", data.use_spring_ang_y)
+    utils.set_property(constraint, "use_spring_ang_z", data.use_spring_ang_z)
+    utils.set_property(constraint, "spring_stiffness_ang_x", data.spring_stiffness_ang_x)
+    utils.set_property(constraint, "spring_stiffness_ang_y", data.spring_stiffness_ang_y)
+    utils.set_property(constraint, "spring_stiffness_ang_z", data.spring_stiffness_ang_z)
+    utils.set_property(constraint, "spring_damping_ang_x", data.spring_damping_ang_x)
+    utils.set_property(constraint, "spring_damping_ang_y", data.spring_damping_ang_y)
+    utils.set_property(constraint, "spring_damping_ang_z", data.spring_damping_ang_z)
+
+    utils.set_property(constraint, "use_spring_x", data.use_spring_x)
+    utils.set_property(constraint, "use_spring_y", data.use_spring_y)
+    utils.set_property(constraint, "use_spring_z", data.use_spring_z)
+    utils.set_property(constraint, "spring_stiffness_x", data.spring_stiffness_x)
+    utils.set_property(constraint, "spring_stiffness_y", data.spring_stiffness_y)
+    utils.set_property(constraint, "spring_stiffness_z", data.spring_stiffness_z)
+    utils.set_property(constraint, "spring_damping_x", data.spring_damping_x)
+    utils.set_property(constraint, "spring_damping_y", data.spring_damping_y)
+    utils.set_property(constraint, "spring_damping_z", data.spring_damping_z)
+
+    utils.set_property(constraint, "use_limit_lin_x", data.use_limit_lin_x)
+    utils.set_property(constraint, "use_limit_lin_y", data.use_limit_lin_y)
+    utils.set_property(constraint, "use_limit_lin_z", data.use_limit_lin_z)
+    utils.set_property(constraint, "use_limit_ang_x", data.use_limit_ang_x)
+    utils.set_property(constraint, "use_limit_ang_y", data.use_limit_ang_y)
+    utils.set_property(constraint, "use_limit_ang_z", data.use_limit_ang_z)
+
+    utils.set_property(constraint, "limit_lin_x_lower", data.limit_lin_x_lower)
+    utils.set_property(constraint, "limit_lin_y_lower", data.limit_lin_y_lower)
+    utils.set_property(constraint, "limit_lin_z_lower", data.limit_lin_z_lower)
+    utils.set_property(constraint, "limit_lin_x_upper", data.limit_lin_x_upper)
+    utils.set_property(constraint, "limit_lin_y_upper", data.limit_lin_y_upper)
+    utils.set_property(constraint, "limit_lin_z_upper", data.limit_lin_z_upper)
 
     # For some strange reason, Blender flips the min/max for the angular limits
-    constraint.limit_ang_x_lower = -data.limit_ang_x_upper
-    constraint.limit_ang_x_upper = -data.limit_ang_x_lower
+    utils.set_property(constraint, "limit_ang_x_lower", -data.limit_ang_x_upper)
+    utils.set_property(constraint, "limit_ang_x_upper", -data.limit_ang_x_lower)
 
-    constraint.limit_ang_y_lower = -data.limit_ang_y_upper
-    constraint.limit_ang_y_upper = -data.limit_ang_y_lower
+    utils.set_property(constraint, "limit_ang_y_lower", -data.limit_ang_y_upper)
+    utils.set_property(constraint, "limit_ang_y_upper", -data.limit_ang_y_lower)
 
-    constraint.limit_ang_z_lower = -data.limit_ang_z_upper
-    constraint.limit_ang_z_upper = -data.limit_ang_z_lower
+    utils.set_property(constraint, "limit_ang_z_lower", -data.limit_ang_z_upper)
+    utils.set_property(constraint, "limit_ang_z_upper", -data.limit_ang_z_lower)
 
 
+# This uses the same scale as the NumPy Batch, so they can't get out of sync
 def hitbox_scale(data, shape):
-    if shape == 'BOX':
-        return data.scale
-    elif shape == 'SPHERE':
-        return Vector((data.scale_diameter, data.scale_diameter, data.scale_diameter))
-    else:
-        return Vector((data.scale_width, data.scale_length, data.scale_width))
+    return Vector(geometry.shape_scale(data, shape))
 
 def hitbox_scale_y(data, shape):
-    if shape == 'BOX':
-        return data.scale.y
-    elif shape == 'SPHERE':
-        return data.scale_diameter
-    else:
-        return data.scale_length
+    return geometry.shape_scale(data, shape)[1]
 
 
 # TODO this is called with both Bone and Compound properties
@@ -424,8 +388,68 @@ def align_hitbox(hitbox, armature, pose_bone, data, is_active):
         utils.set_mesh_cube(hitbox.data, hitbox_dimensions(data, shape, length))
 
 
+# This is the same as align_hitbox and align_origin, except it aligns many hitboxes at once
+def align_hitboxes(armature, hitboxes):
+    batch = geometry.Batch()
+    compounds = geometry.Batch()
+    compound_hitboxes = []
+
+    for (hitbox, pose_bone, data) in hitboxes:
+        shape = data.collision_shape
+        length = bone_length(pose_bone)
+
+        batch.add(data, shape, length)
+
+        if shape == 'COMPOUND':
+            for compound in data.compounds:
+                compounds.add(compound, compound.collision_shape, length, parent=data)
+                compound_hitboxes.append((compound, length))
+
+    if len(batch) != 0:
+        result = batch.hitboxes()
+
+        for (index, (hitbox, pose_bone, data)) in enumerate(hitboxes):
+            if is_bone_active(data):
+                utils.set_property(hitbox.rigid_body, "kinematic", True)
+                utils.set_bone_parent(hitbox, armature, pose_bone.bone.name)
+
+            utils.set_property(hitbox, "location", result.locations[index])
+            utils.set_property(hitbox, "rotation_euler", result.rotations[index])
+
+            if data.collision_shape == 'COMPOUND':
+                utils.set_property(hitbox, "hide_viewport", True)
+                utils.clear_mesh(hitbox.data)
+
+            else:
+                utils.set_property(hitbox, "hide_viewport", False)
+                utils.set_mesh_cube(hitbox.data, result.dimensions[index])
+
+            origin = data.origin_empty
+
+            if origin:
+                update_origin_size(origin, batch.lengths[index])
+                utils.set_property(origin, "location", result.origins[index])
+
+    if len(compounds) != 0:
+        result = compounds.compounds()
+
+        for (index, (compound, length)) in enumerate(compound_hitboxes):
+            hitbox = compound.hitbox
+
+            if hitbox:
+                utils.set_property(hitbox, "location", result.locations[index])
+                utils.set_property(hitbox, "rotation_euler", result.rotations[index])
+                utils.set_mesh_cube(hitbox.data, result.dimensions[index])
+
+            origin = compound.origin_empty
+
+            if origin:
+                update_origin_size(origin, length)
+                utils.set_property(origin, "location", result.origins[index])
+
+
 def update_origin_size(origin, length):
-    origin.empty_display_size = length * 0.05
+    utils.set_property(origin, "empty_display_size", length * 0.05)
 
 def update_origin_location(origin, data, shape, length):
     origin.location = (0.0, 0.0, (length * (0.5 - data.origin)) * hitbox_scale_y(data, shape))
@@ -459,8 +483,8 @@ def align_joint(joint, pose_bone, data, is_active):
 
 
 def update_hitbox_name(hitbox, name):
-    hitbox.name = name
-    hitbox.data.name = name
+    utils.set_property(hitbox, "name", name)
+    utils.set_property(hitbox.data, "name", name)
 
 
 def get_hitbox(data):
@@ -514,10 +538,10 @@ def hide_active_bone(bone, data, should_hide):
         if not data.is_property_set("is_hidden"):
             data.is_hidden = bone.hide
 
-        bone.hide = True
+        utils.set_property(bone, "hide", True)
 
     elif data.is_property_set("is_hidden"):
-        bone.hide = data.is_hidden
+        utils.set_property(bone, "hide", data.is_hidden)
         data.property_unset("is_hidden")
 
 
@@ -541,77 +565,391 @@ def delete_parent(data):
     data.property_unset("use_connect")
 
 
+FLT_EPSILON = 1.1920929e-07
+
+# Removes the shear from the matrix without changing its Y axis, this is the same as orthogonalize_m4_stable in Blender
+def orthogonalize(matrix, normalize):
+    (x, y, z) = (matrix.col[0].xyz, matrix.col[1].xyz, matrix.col[2].xyz)
+
+    # X and Z are projected onto the plane of Y, which keeps the determinant
+    length_squared = y.length_squared
+
+    if length_squared > 0.0:
+        x -= y * (x.dot(y) / length_squared)
+        z -= y * (z.dot(y) / length_squared)
+
+        if normalize:
+            y /= sqrt(length_squared)
+
+    norm_x = x.normalized()
+    norm_z = z.normalized()
+
+    cos_angle = norm_x.dot(norm_z)
+    abs_cos_angle = abs(cos_angle)
+
+    # X and Z are both rotated by half of the shear angle
+    if abs_cos_angle > 1e-4 and abs_cos_angle < 1.0 - FLT_EPSILON:
+        angle = acos(cos_angle)
+        target_angle = angle + ((pi / 2.0) - angle) / 2.0
+
+        norm_x -= norm_z * cos_angle
+        norm_x *= sin(target_angle) / norm_x.length
+        norm_x += norm_z * cos(target_angle)
+
+        norm_z = norm_x.cross(norm_z).cross(norm_x).normalized()
+
+        # This keeps the area and the proportion of X and Z
+        if not normalize:
+            scale = sqrt(sin(angle))
+            x = norm_x * (scale * x.length)
+            z = norm_z * (scale * z.length)
+
+    if normalize:
+        x = norm_x
+        z = norm_z
+
+    result = Matrix((x, y, z)).transposed().to_4x4()
+    result.translation = matrix.translation
+    return result
+
+
+# The uniform scale which has the same volume as the matrix
+def average_scale(matrix):
+    return abs(matrix.to_3x3().determinant()) ** (1.0 / 3.0)
+
+
+# The scale of the matrix, adjusted so that it has the same volume as the sheared matrix
+def shear_scale(matrix):
+    scale = matrix.to_scale()
+    volume = scale.x * scale.y * scale.z
+
+    if volume != 0.0:
+        scale *= (abs(matrix.to_3x3().determinant()) / abs(volume)) ** (1.0 / 3.0)
+
+    return scale
+
+
+def scale_matrix(scale):
+    return Matrix.Diagonal(scale).to_4x4()
+
+
+# Returns how the parent's pose matrix is applied to the bone, taking into account use_inherit_rotation,
+# inherit_scale, and use_local_location, this is the same as BKE_bone_parent_transform_calc_from_matrices
+#
+# If parent_bone is None then it returns how the bone is transformed when it doesn't have a parent
+def parent_transform(bone, parent_bone, parent_matrix):
+    if parent_bone is None:
+        rotscale = bone.matrix_local
+
+        if bone.use_local_location:
+            return (rotscale, rotscale, None)
+
+        else:
+            return (rotscale, Matrix.Translation(rotscale.translation), None)
+
+    offset = parent_bone.matrix_local.inverted_safe() @ bone.matrix_local
+    mode = bone.inherit_scale
+    is_full = bone.use_inherit_rotation and mode == 'FULL'
+    post_scale = None
+
+    if is_full:
+        rotscale = parent_matrix @ offset
+
+    else:
+        if bone.use_inherit_rotation:
+            if mode == 'FIX_SHEAR':
+                matrix = parent_matrix
+
+            elif mode == 'ALIGNED':
+                matrix = orthogonalize(parent_matrix, False)
+                post_scale = matrix.to_scale()
+                matrix = matrix.normalized()
+
+            elif mode == 'NONE_LEGACY':
+                matrix = parent_matrix.normalized()
+
+            # NONE and AVERAGE
+            else:
+                matrix = orthogonalize(parent_matrix, True)
+
+        else:
+            matrix = parent_bone.matrix_local
+
+            if mode == 'FULL':
+                matrix = matrix @ scale_matrix(parent_matrix.to_scale())
+
+            elif mode == 'FIX_SHEAR':
+                matrix = matrix @ scale_matrix(shear_scale(parent_matrix))
+
+            elif mode == 'ALIGNED':
+                post_scale = shear_scale(parent_matrix)
+
+        if mode == 'AVERAGE':
+            scale = average_scale(parent_matrix)
+            matrix = matrix @ scale_matrix((scale, scale, scale))
+
+        rotscale = matrix @ offset
+
+        if mode == 'FIX_SHEAR':
+            rotscale = orthogonalize(rotscale, False)
+
+    # The location is relative to the parent's orientation, not the bone's orientation
+    if not bone.use_local_location:
+        location = Matrix.Translation(parent_matrix @ offset.translation) @ parent_matrix.to_3x3().to_4x4()
+
+    elif is_full:
+        location = rotscale
+
+    # The inherit settings don't change the location
+    else:
+        location = parent_matrix @ offset
+
+    return (rotscale, location, post_scale)
+
+
+# Converts the bone's local matrix into a pose matrix
+def apply_parent_transform(transform, local):
+    (rotscale, location, post_scale) = transform
+
+    matrix = rotscale @ local
+    matrix.translation = location @ local.translation
+
+    if post_scale is not None:
+        matrix = matrix @ scale_matrix(post_scale)
+
+    return matrix
+
+
+# Converts a pose matrix back into the bone's local matrix, this is the inverse of apply_parent_transform
+def local_matrix(transform, matrix):
+    (rotscale, location, post_scale) = transform
+
+    if post_scale is not None:
+        matrix = matrix @ scale_matrix(post_scale).inverted_safe()
+
+    local = rotscale.inverted_safe() @ matrix
+    local.translation = location.inverted_safe() @ matrix.translation
+    return local
+
+
 CONSTRAINT_NAME = "RigidBodyBones [Constraint] "
-CHILD_OF_CONSTRAINT_NAME = "RigidBodyBones [Child Of]"
+CHILD_OF_CONSTRAINT_NAME = utils.CHILD_OF_CONSTRAINT_NAME
+OVERRIDE_CONSTRAINT_NAME = "RigidBodyBones [Override] "
+
+# These reset Active bones to their rest pose, so that keyframes don't move them,
+# without needing to mute the fcurves (which can be shared with other armatures)
+OVERRIDE_CONSTRAINTS = (
+    ('LIMIT_LOCATION', OVERRIDE_CONSTRAINT_NAME + "Location"),
+    ('LIMIT_ROTATION', OVERRIDE_CONSTRAINT_NAME + "Rotation"),
+    ('LIMIT_SCALE', OVERRIDE_CONSTRAINT_NAME + "Scale"),
+)
+
+
+# User constraints are first, then the joint and override constraints, and the Child Of constraint is last
+def constraint_group(name):
+    if name == CHILD_OF_CONSTRAINT_NAME:
+        return 2
+
+    elif name.startswith(CONSTRAINT_NAME) or name.startswith(OVERRIDE_CONSTRAINT_NAME):
+        return 1
+
+    else:
+        return 0
+
+
+# Returns the indexes of a longest strictly increasing subsequence of the values
+def longest_increasing(values):
+    # The index of the smallest last value of the subsequences of each length
+    tails = []
+    tail_values = []
+    previous = [None] * len(values)
+
+    for (index, value) in enumerate(values):
+        length = bisect_left(tail_values, value)
+
+        if length > 0:
+            previous[index] = tails[length - 1]
+
+        if length == len(tails):
+            tails.append(index)
+            tail_values.append(value)
+
+        else:
+            tails[length] = index
+            tail_values[length] = value
+
+    indexes = set()
+
+    index = tails[-1] if len(tails) > 0 else None
+
+    while index is not None:
+        indexes.add(index)
+        index = previous[index]
+
+    return indexes
+
+
+# This indexes the constraints of a pose bone by name, so that the constraints
+# are only searched once per Update, and it sorts the constraints with the
+# minimum number of moves.
+class ConstraintStack:
+    def __init__(self, pose_bone):
+        self.constraints = pose_bone.constraints
+        self.names = {}
+        self.order = []
+
+        for constraint in self.constraints:
+            # Migrate from the old name to the new name
+            if constraint.name == "Rigid Body Bones [Child Of]":
+                constraint.name = CHILD_OF_CONSTRAINT_NAME
+
+            self.names[constraint.name] = constraint
+            self.order.append(constraint.name)
+
+
+    def __iter__(self):
+        return iter(self.names.values())
+
 
+    def get(self, name):
+        return self.names.get(name)
 
-def sort_constraints(pose_bone):
-    constraints = pose_bone.constraints
-    index = None
 
-    for i, constraint in enumerate(constraints):
-        if constraint.name == CHILD_OF_CONSTRAINT_NAME or constraint.name.startswith(CONSTRAINT_NAME):
-            if index is None:
-                index = i
+    def new(self, type, name):
+        constraint = self.constraints.new(type=type)
+        constraint.name = name
 
-        elif index is not None:
-            constraints.move(i, index)
-            index += 1
+        self.names[constraint.name] = constraint
+        self.order.append(constraint.name)
 
+        return constraint
 
-def find_pose_constraint(constraints):
-    index = None
-    found = None
 
-    # TODO can this be replaced with a collection method ?
-    for i, constraint in enumerate(constraints):
-        # Migrate from the old name to the new name
-        if constraint.name == "Rigid Body Bones [Child Of]":
-            constraint.name = CHILD_OF_CONSTRAINT_NAME
+    def remove(self, name):
+        constraint = self.names.pop(name, None)
 
-        if constraint.name == CHILD_OF_CONSTRAINT_NAME:
-            found = constraint
-            index = i
-            break
+        if constraint is not None:
+            self.order.remove(name)
+            self.constraints.remove(constraint)
 
-    return (index, found)
 
+    def sort(self):
+        order = self.order
 
-def mute_pose_constraint(pose_bone):
-    (index, found) = find_pose_constraint(pose_bone.constraints)
+        # This is a stable sort, so the constraints in each group keep their order
+        target = sorted(order, key=constraint_group)
+
+        if target == order:
+            return
+
+        positions = {name: index for (index, name) in enumerate(target)}
+
+        # These constraints are already in the right order relative to each other, so they don't need to move
+        keep = set(order[index] for index in longest_increasing([positions[name] for name in order]))
+
+        for (index, name) in enumerate(target):
+            if name not in keep:
+                old_index = order.index(name)
+                del order[old_index]
+
+                if index == 0:
+                    new_index = 0
+                else:
+                    new_index = order.index(target[index - 1]) + 1
+
+                order.insert(new_index, name)
+                self.constraints.move(old_index, new_index)
+
+
+def init_override_constraint(constraint):
+    constraint.owner_space = 'LOCAL'
+    constraint.show_expanded = False
+
+    for axis in ("x", "y", "z"):
+        if constraint.type == 'LIMIT_ROTATION':
+            setattr(constraint, "use_limit_" + axis, True)
+            setattr(constraint, "min_" + axis, 0.0)
+            setattr(constraint, "max_" + axis, 0.0)
+
+        else:
+            if constraint.type == 'LIMIT_SCALE':
+                value = 1.0
+            else:
+                value = 0.0
+
+            setattr(constraint, "use_min_" + axis, True)
+            setattr(constraint, "use_max_" + axis, True)
+            setattr(constraint, "min_" + axis, value)
+            setattr(constraint, "max_" + axis, value)
+
+
+def create_override_constraints(stack):
+    for (type, name) in OVERRIDE_CONSTRAINTS:
+        constraint = stack.get(name)
+
+        if constraint is None:
+            constraint = stack.new(type, name)
+            init_override_constraint(constraint)
+
+        utils.set_property(constraint, "mute", False)
+
+
+def remove_override_constraints(stack):
+    for (type, name) in OVERRIDE_CONSTRAINTS:
+        stack.remove(name)
+
+
+# Returns True if a constraint was unmuted
+def mute_pose_constraint(stack):
+    is_unmuted = False
+
+    # This is needed so that the pose matrix includes the keyframes
+    for (type, name) in OVERRIDE_CONSTRAINTS:
+        constraint = stack.get(name)
+
+        if constraint is not None and not constraint.mute:
+            constraint.mute = True
+            is_unmuted = True
+
+    found = stack.get(CHILD_OF_CONSTRAINT_NAME)
 
     if found:
+        if not found.mute:
+            is_unmuted = True
+
         found.mute = True
         found.target = None
 
+    return is_unmuted
 
-def remove_pose_constraint(pose_bone, data):
-    constraints = pose_bone.constraints
 
-    unmute_constraints(constraints, data)
+def remove_pose_constraint(stack, data):
+    unmute_constraints(stack, data)
 
-    (index, found) = find_pose_constraint(constraints)
+    remove_override_constraints(stack)
 
-    if found:
-        # TODO can this remove an index instead, to make it faster ?
-        constraints.remove(found)
+    stack.remove(CHILD_OF_CONSTRAINT_NAME)
+
+
+def is_hidden_constraint(constraint):
+    return constraint.name != CHILD_OF_CONSTRAINT_NAME and not constraint.name.startswith(OVERRIDE_CONSTRAINT_NAME)
 
 
-def mute_constraints(constraints, data):
+def mute_constraints(stack, data):
     data.is_constraints_hidden = True
 
-    for constraint in constraints:
-        if constraint.name != CHILD_OF_CONSTRAINT_NAME:
+    for constraint in stack:
+        if is_hidden_constraint(constraint):
             # Unfortunately we cannot save the old muting, so we can't restore it later
-            constraint.mute = True
+            utils.set_property(constraint, "mute", True)
 
 
-def unmute_constraints(constraints, data):
+def unmute_constraints(stack, data):
     if data.is_constraints_hidden:
         data.property_unset("is_constraints_hidden")
 
-        for constraint in constraints:
-            if constraint.name != CHILD_OF_CONSTRAINT_NAME:
+        for constraint in stack:
+            if is_hidden_constraint(constraint):
                 if constraint.name.startswith(CONSTRAINT_NAME):
                     constraint.mute = True
                 else:
@@ -619,28 +957,37 @@ def unmute_constraints(constraints, data):
                     constraint.mute = False
 
 
-def create_pose_constraint(armature, pose_bone, data, is_active):
-    constraints = pose_bone.constraints
+# This is the bone's matrix (relative to the armature) when the Child Of constraint is evaluated
+def owner_matrix(pose_bone, is_override):
+    # The override constraints reset the matrix_basis
+    if is_override:
+        return pose_bone.bone.matrix_local
 
-    if is_active:
-        mute_constraints(constraints, data)
     else:
-        unmute_constraints(constraints, data)
+        return pose_bone.bone.matrix_local @ pose_bone.matrix_basis
 
 
-    (index, found) = find_pose_constraint(constraints)
+# The inverse_matrix is calculated later by update_pose_inverses, so that
+# all of the matrices can be inverted at once
+def create_pose_constraint(stack, pose_bone, data, is_active, is_override, inverses):
+    if is_active:
+        mute_constraints(stack, data)
+    else:
+        unmute_constraints(stack, data)
 
-    if found is None:
-        index = len(constraints)
-        found = constraints.new(type='CHILD_OF')
-        found.name = CHILD_OF_CONSTRAINT_NAME
+    is_override = is_active and is_override
+
+    if is_override:
+        create_override_constraints(stack)
+    else:
+        remove_override_constraints(stack)
 
-    assert index is not None
 
-    last = len(constraints) - 1
+    # The Child Of constraint is moved to the end of the stack by ConstraintStack.sort
+    found = stack.get(CHILD_OF_CONSTRAINT_NAME)
 
-    if index != last:
-        constraints.move(index, last)
+    if found is None:
+        found = stack.new('CHILD_OF', CHILD_OF_CONSTRAINT_NAME)
 
 
     hitbox = data.active
@@ -653,21 +1000,31 @@ def create_pose_constraint(armature, pose_bone, data, is_active):
         found.mute = False
         found.target = hitbox
 
-        found.inverse_matrix = (
-            # TODO rather than using matrix_world, instead manually calculate the hitbox's matrix
-            # This is the same as the standard Set Inverse
-            hitbox.matrix_world.inverted() @ armature.matrix_world @
-            # This is needed because we're removing the parent, so we have to preserve the parent transformations
-            # It inverts the matrix_basis and matrix_local in order to reset the position to the armature's origin
-            # And then it adds the matrix in order to move it to where it should be based on its parent
-            pose_bone.matrix @ pose_bone.matrix_basis.inverted() @ pose_bone.bone.matrix_local.inverted()
-        )
+        # This is the same as the standard Set Inverse, except it doesn't use the hitbox's matrix_world,
+        # which might not have been evaluated yet:
+        #
+        #   hitbox.matrix_world.inverted() @ armature.matrix_world @ pose_matrix @ owner_matrix.inverted()
+        #
+        # The hitbox is parented to the bone's joint, and the joint's matrix_world is
+        # armature.matrix_world @ pose_matrix (the pose bone's matrix with its parents restored),
+        # so those cancel out and only the hitbox's local matrix is left
+        hitbox_matrix = hitbox.matrix_parent_inverse @ hitbox.matrix_basis
+
+        inverses.append((found, owner_matrix(pose_bone, is_override) @ hitbox_matrix))
 
     else:
         found.mute = True
         found.target = None
 
 
+def update_pose_inverses(inverses):
+    if len(inverses) != 0:
+        matrices = geometry.invert_matrices([matrix for (constraint, matrix) in inverses])
+
+        for ((constraint, _), matrix) in zip(inverses, matrices):
+            constraint.inverse_matrix = Matrix(matrix)
+
+
 # TODO better way of doing this
 def copy_properties(active, data):
     data.enabled = active.enabled
@@ -13,10 +13,57 @@ def event_update(context, dirty, armature):
         bpy.ops.rigid_body_bones.update()
 
 
+@utils.event("mode")
+def event_mode(context, dirty, armature):
+    # event_update already updates everything, so we don't need to run this too
+    if not dirty.update:
+        with utils.Selected(context), utils.Selectable(context):
+            utils.select_active(context, armature)
+            assert context.active_object.name == armature.name
+            bpy.ops.rigid_body_bones.update(mode_switch=True)
+
+
+@utils.event("rename")
+@utils.if_armature_enabled
+def event_rename(context, dirty, armature, top):
+    with utils.Selected(context), utils.Selectable(context):
+        utils.select_active(context, armature)
+        assert context.active_object.name == armature.name
+        bpy.ops.rigid_body_bones.rename()
+
+
+@utils.event("load")
+def event_load(context, dirty, armature):
+    # event_update already updates everything, so we don't need to run this too
+    if not dirty.update:
+        with utils.Selected(context), utils.Selectable(context):
+            utils.select_active(context, armature)
+            assert context.active_object.name == armature.name
+            bpy.ops.rigid_body_bones.update(file_loaded=True)
+
+
+# This runs when a different armature changed the bones which this armature's joints are connected to
+@utils.event("dependents")
+def event_dependents(context, dirty, armature):
+    # event_update already updates everything, so we don't need to run this too
+    if not dirty.update:
+        with utils.Selected(context), utils.Selectable(context):
+            utils.select_active(context, armature)
+            assert context.active_object.name == armature.name
+
+            # The dirty bones are unknown, so every bone is reconciled
+            if dirty.all_bones:
+                bpy.ops.rigid_body_bones.update(full=True)
+
+            else:
+                utils.force_bones(armature, dirty.bones)
+                bpy.ops.rigid_body_bones.update()
+
+
 @utils.event("rigid_body")
 @utils.if_armature_pose
 def event_rigid_body(context, dirty, armature, top):
-    for bone in armature.data.bones:
+    for bone in utils.dirty_bones(dirty, armature.data.bones):
         data = bone.rigid_body_bones
 
         if data.active:
@@ -29,7 +76,7 @@ def event_rigid_body(context, dirty, armature, top):
 @utils.event("rigid_body_constraint")
 @utils.if_armature_pose
 def event_rigid_body_constraint(context, dirty, armature, top):
-    for bone in armature.data.bones:
+    for bone in utils.dirty_bones(dirty, armature.data.bones):
         data = bone.rigid_body_bones
 
         constraint = data.constraint
@@ -47,17 +94,19 @@ def event_rigid_body_constraint(context, dirty, armature, top):
 @utils.event("align")
 @utils.if_armature_pose
 def event_align(context, dirty, armature, top):
-    for pose_bone in armature.pose.bones:
+    hitboxes = []
+
+    for pose_bone in utils.dirty_bones(dirty, armature.pose.bones):
         bone = pose_bone.bone
         data = bone.rigid_body_bones
 
-        if data.active:
-            bones.align_hitbox(data.active, armature, pose_bone, data, False)
+        hitbox = bones.get_hitbox(data)
 
-        elif data.passive:
-            bones.align_hitbox(data.passive, armature, pose_bone, data, False)
+        # The hitboxes are aligned all at once, which is much faster than aligning them one at a time
+        if hitbox:
+            hitboxes.append((hitbox, pose_bone, data))
 
-        if data.origin_empty:
+        elif data.origin_empty:
             bones.align_origin(data.origin_empty, pose_bone, data)
 
         for joint in data.constraints:
@@ -66,6 +115,8 @@ def event_align(context, dirty, armature, top):
             if constraint:
                 bones.align_joint(constraint, pose_bone, joint, False)
 
+    bones.align_hitboxes(armature, hitboxes)
+
 
 @utils.event("hide_hitboxes")
 @utils.if_armature_enabled
@@ -105,10 +156,9 @@ def mode_switch():
         # TODO handle this better, such as a "do not update mode" flag
         if top.mode != mode:
             top.mode = mode
-            event_update(None, context)
+            event_mode(None, context)
 
 
-# TODO make this an event ?
 def bone_name_changed():
     context = bpy.context
 
@@ -116,8 +166,7 @@ def bone_name_changed():
         armature = context.active_object
 
         if armature.mode != 'EDIT':
-            # TODO maybe this doesn't need a full update, but only a partial name update ?
-            event_update(None, context)
+            event_rename(None, context)
 
 
 # This is needed to cleanup the rigid body objects when the armature is deleted
@@ -125,13 +174,60 @@ def cleanup_armatures():
     if bpy.ops.rigid_body_bones.cleanup_armatures.poll():
         bpy.ops.rigid_body_bones.cleanup_armatures()
 
-    return 5.0
+    return None
+
 
+def schedule_cleanup():
+    if not bpy.app.timers.is_registered(cleanup_armatures):
+        bpy.app.timers.register(cleanup_armatures)
 
+
+# This is used to detect when armatures or collections are deleted
+ID_COUNTS = {
+    "armatures": 0,
+    "collections": 0,
+}
+
+def update_id_counts():
+    armatures = len(bpy.data.armatures)
+    collections = len(bpy.data.collections)
+
+    is_deleted = armatures < ID_COUNTS["armatures"] or collections < ID_COUNTS["collections"]
+
+    ID_COUNTS["armatures"] = armatures
+    ID_COUNTS["collections"] = collections
+
+    return is_deleted
+
+
+# This only does the cleanup when something was deleted, so it costs almost nothing otherwise
+@persistent
+def depsgraph_update_post(scene, depsgraph):
+    if update_id_counts():
+        schedule_cleanup()
+
+    # The fcurves might have been added, removed, or muted
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Action):
+            utils.action_changed(update.id.original)
+
+    # The changes made by mute_fcurves have been handled, so the next changes are made by the user
+    utils.clear_muted_actions()
+
+
+def repair_undo():
+    bpy.ops.rigid_body_bones.repair_undo()
+    return None
+
+
+# This only checks whether the objects are broken, it doesn't do a full update
 @persistent
 def fix_undo(scene):
-    context = bpy.context
-    event_update(None, context)
+    utils.clear_fcurve_indexes()
+    utils.rebuild_dependents()
+
+    if not bpy.app.timers.is_registered(repair_undo):
+        bpy.app.timers.register(repair_undo)
 
 
 owner = object()
@@ -161,9 +257,17 @@ def register_subscribers():
 def load_post(dummy):
     register_subscribers()
 
+    utils.clear_armature_caches()
+    utils.clear_fcurve_indexes()
+    utils.rebuild_dependents()
+
+    # The file might have been saved with orphan objects
+    update_id_counts()
+    schedule_cleanup()
+
     # When opening an old file, if an armature is selected it will update it.
-    # This is only really needed when updating the add-on.
-    event_update(None, bpy.context)
+    # This is only really needed when updating the add-on, so it is skipped if nothing changed.
+    event_load(None, bpy.context)
 
 
 def register():
@@ -173,10 +277,11 @@ def register():
     bpy.app.handlers.load_post.append(load_post)
 
     # This is needed in order to fix up problems caused by undo/redo
-    #bpy.app.handlers.undo_post.append(fix_undo)
-    #bpy.app.handlers.redo_post.append(fix_undo)
+    bpy.app.handlers.undo_post.append(fix_undo)
+    bpy.app.handlers.redo_post.append(fix_undo)
 
-    bpy.app.timers.register(cleanup_armatures, persistent=True)
+    # This is needed in order to cleanup after armatures are deleted
+    bpy.app.handlers.depsgraph_update_post.append(depsgraph_update_post)
 
     register_subscribers()
 
@@ -189,6 +294,12 @@ def unregister():
     if bpy.app.timers.is_registered(cleanup_armatures):
         bpy.app.timers.unregister(cleanup_armatures)
 
+    if depsgraph_update_post in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(depsgraph_update_post)
+
+    if bpy.app.timers.is_registered(repair_undo):
+        bpy.app.timers.unregister(repair_undo)
+
     if fix_undo in bpy.app.handlers.redo_post:
         bpy.app.handlers.redo_post.remove(fix_undo)
 
@@ -0,0 +1,164 @@
+import numpy
+from math import radians
+
+
+# This calculates the hitbox transformations for many bones at once.
+#
+# It does the same math as hitbox_location, hitbox_rotation, hitbox_dimensions,
+# hitbox_origin, and update_origin_location (in bones.py), but with NumPy.
+
+
+def euler_matrices(rotations):
+    (x, y, z) = numpy.asarray(rotations, dtype=numpy.float64).reshape(-1, 3).T
+
+    (sx, sy, sz) = (numpy.sin(x), numpy.sin(y), numpy.sin(z))
+    (cx, cy, cz) = (numpy.cos(x), numpy.cos(y), numpy.cos(z))
+
+    matrices = numpy.empty((len(x), 3, 3))
+
+    # This is the same as Rz @ Ry @ Rx, which is what mathutils uses for XYZ eulers
+    matrices[:, 0, 0] = cy * cz
+    matrices[:, 0, 1] = sx * sy * cz - cx * sz
+    matrices[:, 0, 2] = cx * sy * cz + sx * sz
+    matrices[:, 1, 0] = cy * sz
+    matrices[:, 1, 1] = sx * sy * sz + cx * cz
+    matrices[:, 1, 2] = cx * sy * sz - sx * cz
+    matrices[:, 2, 0] = -sy
+    matrices[:, 2, 1] = sx * cy
+    matrices[:, 2, 2] = cx * cy
+
+    return matrices
+
+
+def matrix_eulers(matrices):
+    cy = numpy.hypot(matrices[:, 0, 0], matrices[:, 1, 0])
+
+    # When the Y rotation is +-90 degrees the X and Z rotations are the same axis
+    is_locked = cy <= 16.0 * numpy.finfo(numpy.float32).eps
+
+    x = numpy.where(
+        is_locked,
+        numpy.arctan2(-matrices[:, 1, 2], matrices[:, 1, 1]),
+        numpy.arctan2(matrices[:, 2, 1], matrices[:, 2, 2]),
+    )
+
+    y = numpy.arctan2(-matrices[:, 2, 0], cy)
+
+    z = numpy.where(
+        is_locked,
+        0.0,
+        numpy.arctan2(matrices[:, 1, 0], matrices[:, 0, 0]),
+    )
+
+    return numpy.stack((x, y, z), axis=-1)
+
+
+def invert_matrices(matrices):
+    matrices = numpy.array(matrices, dtype=numpy.float64).reshape(-1, 4, 4)
+    return numpy.linalg.inv(matrices).tolist()
+
+
+ROTATE_X_90 = euler_matrices([(radians(90.0), 0.0, 0.0)])[0]
+ROTATE_X_MINUS_90 = euler_matrices([(radians(-90.0), 0.0, 0.0)])[0]
+
+
+# TODO this is called with both Bone and Compound properties
+def shape_scale(data, shape):
+    if shape == 'BOX':
+        return tuple(data.scale)
+    elif shape == 'SPHERE':
+        return (data.scale_diameter, data.scale_diameter, data.scale_diameter)
+    else:
+        return (data.scale_width, data.scale_length, data.scale_width)
+
+
+# Blender stores locations, rotations, and vertices as 32-bit floats, so the results are rounded
+# to 32-bit, that way utils.set_property can tell when the values haven't changed
+def to_floats(array):
+    return array.astype(numpy.float32).tolist()
+
+
+class Result:
+    def __init__(self, locations, rotations, dimensions, origins):
+        self.locations = to_floats(locations)
+        self.rotations = to_floats(rotations)
+        self.dimensions = to_floats(dimensions)
+        self.origins = to_floats(origins)
+
+
+class Batch:
+    def __init__(self):
+        self.lengths = []
+        self.origins = []
+        self.scales = []
+        self.locations = []
+        self.rotations = []
+
+        # This is only used for compounds, it is the origin of the compound's bone
+        self.parent_origins = []
+
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+    def add(self, data, shape, length, parent=None):
+        self.lengths.append(length)
+        self.origins.append(data.origin)
+        self.scales.append(shape_scale(data, shape))
+        self.locations.append(tuple(data.location))
+        self.rotations.append(tuple(data.rotation))
+
+        if parent is not None:
+            self.parent_origins.append(parent.origin)
+
+
+    def calculate(self):
+        lengths = numpy.array(self.lengths, dtype=numpy.float64)
+        origins = numpy.array(self.origins, dtype=numpy.float64)
+        scales = numpy.array(self.scales, dtype=numpy.float64).reshape(-1, 3)
+        locations = numpy.array(self.locations, dtype=numpy.float64).reshape(-1, 3)
+        rotation_matrices = euler_matrices(self.rotations)
+
+        offsets = lengths * (origins - 0.5)
+
+        # hitbox_location
+        centers = numpy.zeros((len(lengths), 3))
+        centers[:, 1] = -offsets * scales[:, 1]
+        centers = numpy.einsum("nij,nj->ni", rotation_matrices, centers)
+        centers[:, 1] += offsets - (lengths * 0.5)
+        centers += locations
+
+        # hitbox_rotation
+        rotations = rotation_matrices @ ROTATE_X_90
+
+        # hitbox_dimensions
+        dimensions = (scales * lengths[:, None]) @ ROTATE_X_90.T
+
+        # update_origin_location
+        origin_locations = numpy.zeros((len(lengths), 3))
+        origin_locations[:, 2] = (lengths * (0.5 - origins)) * scales[:, 1]
+
+        return (centers, rotations, dimensions, origin_locations)
+
+
+    def hitboxes(self):
+        (locations, rotations, dimensions, origins) = self.calculate()
+
+        return Result(locations, matrix_eulers(rotations), dimensions, origins)
+
+
+    # Compounds are relative to the bone's hitbox
+    def compounds(self):
+        (locations, rotations, dimensions, origins) = self.calculate()
+
+        lengths = numpy.array(self.lengths, dtype=numpy.float64)
+        parent_origins = numpy.array(self.parent_origins, dtype=numpy.float64)
+
+        # hitbox_origin
+        locations[:, 1] -= lengths * (parent_origins - 1.0)
+        locations = locations @ ROTATE_X_MINUS_90.T
+
+        rotations = ROTATE_X_MINUS_90 @ rotations
+
+        return Result(locations, matrix_eulers(rotations), dimensions, origins)
@@ -81,6 +81,9 @@ class RigidBodyMenu(bpy.types.Menu):
         self.layout.operator("rigid_body_bones.calculate_mass")
         self.layout.operator("rigid_body_bones.copy_from_active")
         self.layout.operator("rigid_body_bones.bake_to_keyframes")
+        self.layout.separator()
+        self.layout.operator("rigid_body_bones.verify_armature")
+        self.layout.operator("rigid_body_bones.update_all")
 
 
 class ArmaturePanel(bpy.types.Panel):
@@ -144,6 +147,10 @@ class ArmatureSettingsPanel(bpy.types.Panel):
         col.enabled = data.enabled
         col.prop(data, "run_simulation")
 
+        col = flow.column()
+        col.enabled = data.enabled
+        col.prop(data, "override_keyframes")
+
         flow.separator()
 
         col = flow.column()
@@ -0,0 +1,72 @@
+# This figures out which objects need to be created, renamed, or removed.
+#
+# It doesn't use bpy, it only compares the desired state with the objects
+# which already exist, so it can be tested and benchmarked outside of Blender.
+
+
+# The order that the objects are created in
+KINDS = ('ACTIVE', 'PASSIVE', 'COMPOUND', 'ORIGIN')
+
+
+class Slot:
+    def __init__(self, kind, bone, owner, attribute, name):
+        self.kind = kind
+        self.bone = bone
+        self.owner = owner
+        self.attribute = attribute
+        self.name = name
+
+
+# Stores the new objects in the slots, the objects are in the same order as the slots
+def fill_slots(slots, objects):
+    for (slot, object) in zip(slots, objects):
+        setattr(slot.owner, slot.attribute, object)
+
+
+class Plan:
+    def __init__(self):
+        # Slots which need a new object, grouped by kind
+        self.creates = {kind: [] for kind in KINDS}
+
+        # Existing objects which need a new name
+        self.renames = []
+
+        # Slots which have an object that needs to be removed
+        self.removes = []
+
+        # Slots which already have the correct object
+        self.skipped = 0
+
+
+    def __len__(self):
+        return sum(len(slots) for slots in self.creates.values()) + len(self.renames) + len(self.removes)
+
+
+    def keep(self, kind, bone, owner, attribute, name):
+        object = getattr(owner, attribute)
+
+        if object is None:
+            self.creates[kind].append(Slot(kind, bone, owner, attribute, name))
+
+        elif object.name != name:
+            self.renames.append((object, name))
+
+        else:
+            self.skipped += 1
+
+
+    def remove(self, owner, attribute):
+        if getattr(owner, attribute) is not None:
+            self.removes.append((owner, attribute))
+
+        else:
+            self.skipped += 1
+
+
+    def summary(self):
+        return "PLAN {} creates, {} renames, {} removes, {} skipped".format(
+            sum(len(slots) for slots in self.creates.values()),
+            len(self.renames),
+            len(self.removes),
+            self.skipped,
+        )
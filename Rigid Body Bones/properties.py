@@ -3,7 +3,7 @@ from . import utils
 from .bones import shape_icon, CONSTRAINT_NAME
 from .events import (
     event_update, event_rigid_body, event_rigid_body_constraint, event_align,
-    event_hide_hitboxes, event_hide_active_bones,
+    event_hide_hitboxes, event_hide_active_bones, event_rename,
 )
 
 
@@ -13,18 +13,38 @@ MAX_ROT = 3.14159265358979323846 * 2.0
 MIN_ROT = -MAX_ROT
 
 
-class Dirty(bpy.types.PropertyGroup):
-    armature: bpy.props.PointerProperty(type=bpy.types.Object)
-    update: bpy.props.BoolProperty(default=False)
-    rigid_body: bpy.props.BoolProperty(default=False)
-    rigid_body_constraint: bpy.props.BoolProperty(default=False)
-    align: bpy.props.BoolProperty(default=False)
-    hide_hitboxes: bpy.props.BoolProperty(default=False)
-    hide_active_bones: bpy.props.BoolProperty(default=False)
+class Preferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    update_rate: bpy.props.FloatProperty(
+        name="Update rate",
+        description="Maximum number of times per second that hitboxes are updated while dragging a property",
+        default=30.0,
+        min=1.0,
+        max=240.0,
+        step=100,
+        precision=0,
+    )
+
+    settle_delay: bpy.props.FloatProperty(
+        name="Settle delay",
+        description="How many seconds to wait after a property stops changing before doing the full update",
+        default=0.15,
+        min=0.0,
+        max=2.0,
+        step=1,
+        precision=2,
+        unit='TIME',
+    )
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.prop(self, "update_rate")
+        layout.prop(self, "settle_delay")
 
 
 class Scene(bpy.types.PropertyGroup):
-    dirties: bpy.props.CollectionProperty(type=Dirty)
     collection: bpy.props.PointerProperty(type=bpy.types.Collection)
 
     @classmethod
@@ -40,11 +60,20 @@ class Error(bpy.types.PropertyGroup):
     name: bpy.props.StringProperty()
 
 
+# This keeps track of which objects were created for which bone
+class Registered(bpy.types.PropertyGroup):
+    bone: bpy.props.StringProperty()
+    slot: bpy.props.StringProperty()
+    object: bpy.props.PointerProperty(type=bpy.types.Object)
+
+
 class Armature(bpy.types.PropertyGroup):
     mode: bpy.props.StringProperty()
 
     errors: bpy.props.CollectionProperty(type=Error)
 
+    registry: bpy.props.CollectionProperty(type=Registered)
+
     container: bpy.props.PointerProperty(type=bpy.types.Collection)
     actives: bpy.props.PointerProperty(type=bpy.types.Collection)
     passives: bpy.props.PointerProperty(type=bpy.types.Collection)
@@ -56,6 +85,13 @@ class Armature(bpy.types.PropertyGroup):
     root_body: bpy.props.PointerProperty(type=bpy.types.Object)
     parents_stored: bpy.props.BoolProperty(default=False)
 
+    # Whether the fcurves were unmuted after switching to override mode
+    fcurves_unmuted: bpy.props.BoolProperty(default=False)
+
+    # The add-on version and bones which were used for the last Update
+    schema_version: bpy.props.IntProperty(default=0)
+    fingerprint: bpy.props.StringProperty()
+
 
     enabled: bpy.props.BoolProperty(
         name="Enable rigid body physics",
@@ -71,6 +107,13 @@ class Armature(bpy.types.PropertyGroup):
         update=event_update,
     )
 
+    override_keyframes: bpy.props.BoolProperty(
+        name="Override keyframes",
+        description="Use constraints to stop keyframes from moving Active bones, instead of muting the fcurves of the actions",
+        default=False,
+        update=event_update,
+    )
+
     hide_active_bones: bpy.props.BoolProperty(
         name="Hide active bones",
         description="Hide bones which have an Active rigid body",
@@ -237,8 +280,7 @@ class Compound(bpy.types.PropertyGroup, ShapeProperties):
                 self.name = utils.make_unique_name(utils.strip_name_suffix(self.name), seen)
                 Compound.is_updating = False
 
-            # TODO maybe this can do a partial update rather than a full update ?
-            event_update(None, context)
+            event_rename(self, context)
 
     hitbox: bpy.props.PointerProperty(type=bpy.types.Object)
     origin_empty: bpy.props.PointerProperty(type=bpy.types.Object)
@@ -700,10 +742,7 @@ class Constraint(bpy.types.PropertyGroup, ConstraintProperties):
         name = self.constraint_name
 
         if name != "":
-            # TODO can this be replaced with a collection method ?
-            for constraint in pose_bone.constraints:
-                if constraint.name == name:
-                    return constraint
+            return pose_bone.constraints.get(name)
 
 
     def remove_joint_constraint(self, pose_bone):
@@ -715,14 +754,34 @@ class Constraint(bpy.types.PropertyGroup, ConstraintProperties):
             pose_bone.constraints.remove(found)
 
 
-    def create_joint_constraint(self, pose_bone):
+    def rename_joint_constraint(self, pose_bone):
         found = self.find_joint_constraint(pose_bone)
 
+        if found:
+            utils.set_property(found, "name", CONSTRAINT_NAME + self.name)
+            utils.set_property(self, "constraint_name", found.name)
+
+            # Blender changes the subtarget when the target bone is renamed
+            if not self.target_changed:
+                Constraint.is_updating = True
+                utils.set_property(self, "target", found.pole_target)
+                utils.set_property(self, "subtarget", found.pole_subtarget)
+                Constraint.is_updating = False
+
+
+    # The stack is a ConstraintStack for the pose bone
+    def create_joint_constraint(self, stack):
+        name = self.constraint_name
+
+        if name != "":
+            found = stack.get(name)
+        else:
+            found = None
+
         should_set = found is None or self.target_changed
 
         if found is None:
-            found = pose_bone.constraints.new(type='IK')
-            found.name = CONSTRAINT_NAME + self.name
+            found = stack.new('IK', CONSTRAINT_NAME + self.name)
             self.constraint_name = found.name
 
         found.show_expanded = False
@@ -760,8 +819,7 @@ class Constraint(bpy.types.PropertyGroup, ConstraintProperties):
                 self.name = utils.make_unique_name(utils.strip_name_suffix(self.name), seen)
                 Constraint.is_updating = False
 
-            # TODO maybe this can do a partial update rather than a full update ?
-            event_update(None, context)
+            event_rename(self, context)
 
 
     def update_target(self, context):
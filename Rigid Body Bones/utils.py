@@ -2,13 +2,16 @@ import re
 import sys
 import time
 import bpy
-import bmesh
 from math import radians
 from mathutils import Vector, Euler, Matrix
 
 
 DEBUG = False
 
+# This must be incremented whenever the add-on changes what Update creates,
+# so that files saved with an older version are rebuilt
+SCHEMA_VERSION = 1
+
 def log(obj):
     from pprint import PrettyPrinter
     PrettyPrinter(indent = 4).pprint(obj)
@@ -33,13 +36,15 @@ def timed(name):
 
             time_start = time.time()
 
-            f(*args)
+            result = f(*args)
 
             time_end = time.time()
             print_time(time_start, time_end)
 
             debug("}")
 
+            return result
+
         return update
     return decorator
 
@@ -125,20 +130,257 @@ class Viewable:
         return False
 
 
-# Temporarily resets the frame to the starting simulation frame
+re_pose_path = re.compile(r"""^pose\.bones\["([^"]+)"\]\.([a-z_]+)$""")
+
+# This is the name of the Child Of constraints which follow the hitboxes, it is here
+# (instead of in bones.py) so that pose_fcurves can use it
+CHILD_OF_CONSTRAINT_NAME = "RigidBodyBones [Child Of]"
+
+
+def is_other_target(armature, target):
+    return target is not None and target != armature
+
+
+# Returns True if the constraint depends on an object other than the armature
+def has_other_target(armature, constraint):
+    if is_other_target(armature, getattr(constraint, "target", None)):
+        return True
+
+    if is_other_target(armature, getattr(constraint, "pole_target", None)):
+        return True
+
+    # Armature constraints have multiple targets
+    targets = getattr(constraint, "targets", None)
+
+    if targets is not None:
+        for target in targets:
+            if is_other_target(armature, target.target):
+                return True
+
+    return False
+
+
+# Returns the fcurves which animate the armature's pose.
+#
+# Returns None if the pose depends on more than just the armature's
+# action (e.g. drivers, NLA, or constraints which target other objects).
+def pose_fcurves(armature):
+    for pose_bone in armature.pose.bones:
+        for constraint in pose_bone.constraints:
+            # The Child Of constraints are muted before the pose is used, and their inverse_matrix
+            # is calculated from local matrices, so it doesn't matter where the hitboxes are
+            if not constraint.mute and constraint.name != CHILD_OF_CONSTRAINT_NAME:
+                if has_other_target(armature, constraint):
+                    return None
+
+    animation_data = armature.animation_data
+
+    if animation_data is None:
+        return []
+
+    if len(animation_data.drivers) > 0:
+        return None
+
+    for track in animation_data.nla_tracks:
+        if not track.mute:
+            return None
+
+    action = animation_data.action
+
+    if action is None:
+        return []
+
+    if getattr(animation_data, "action_influence", 1.0) != 1.0:
+        return None
+
+    if getattr(animation_data, "action_blend_type", 'REPLACE') != 'REPLACE':
+        return None
+
+    fcurves = []
+
+    for fcurve in action.fcurves:
+        if not fcurve.mute:
+            match = re_pose_path.match(fcurve.data_path)
+
+            if match is None:
+                return None
+
+            else:
+                fcurves.append((match.group(1), match.group(2), fcurve))
+
+    return fcurves
+
+
+re_pose_bone = re.compile(r"""^pose\.bones\["([^"]+)"\]""")
+
+# Action pointer -> FcurveIndex
+FCURVE_INDEXES = {}
+
+# This makes it fast to find the fcurves for a bone, without needing to search every fcurve
+class FcurveIndex:
+    def __init__(self, action):
+        self.length = len(action.fcurves)
+
+        # Bone name -> indexes of the bone's fcurves
+        self.bones = {}
+
+        # Bone name -> whether the bone's fcurves were muted by mute_fcurves
+        self.muted = {}
+
+        for (index, fcurve) in enumerate(action.fcurves):
+            match = re_pose_bone.match(fcurve.data_path)
+
+            if match:
+                self.bones.setdefault(match.group(1), []).append(index)
+
+
+def fcurve_index(action):
+    key = action.as_pointer()
+
+    index = FCURVE_INDEXES.get(key)
+
+    if index is None or index.length != len(action.fcurves):
+        index = FcurveIndex(action)
+        FCURVE_INDEXES[key] = index
+
+    return index
+
+
+# Pointers of the actions which were changed by mute_fcurves, so that the
+# depsgraph update which it causes doesn't invalidate the fcurve index
+MUTED_ACTIONS = set()
+
+
+def invalidate_fcurve_index(action):
+    FCURVE_INDEXES.pop(action.as_pointer(), None)
+
+
+# This is called when an action is changed
+def action_changed(action):
+    key = action.as_pointer()
+
+    if key in MUTED_ACTIONS:
+        MUTED_ACTIONS.discard(key)
+
+    else:
+        FCURVE_INDEXES.pop(key, None)
+
+
+def clear_muted_actions():
+    MUTED_ACTIONS.clear()
+
+
+def clear_fcurve_indexes():
+    FCURVE_INDEXES.clear()
+    MUTED_ACTIONS.clear()
+
+
+# This only changes the fcurves of the bones which have a different mute state
+def mute_fcurves(action, should_mute):
+    index = fcurve_index(action)
+    fcurves = action.fcurves
+
+    for (name, mute) in should_mute.items():
+        if index.muted.get(name) != mute:
+            index.muted[name] = mute
+
+            indexes = index.bones.get(name)
+
+            if indexes:
+                for i in indexes:
+                    if set_property(fcurves[i], "mute", mute):
+                        MUTED_ACTIONS.add(action.as_pointer())
+
+
+# Temporarily changes the scene to the starting simulation frame, but only if
+# one of the armatures needs it. This is used when updating many armatures,
+# so that the scene's frame is only changed once instead of once per armature.
+class SceneFrame:
+    def __init__(self, context, armatures):
+        self.scene = context.scene
+        self.armatures = armatures
+        self.old_frame = None
+
+    def __enter__(self):
+        scene = self.scene
+
+        if scene.rigidbody_world:
+            frame = scene.rigidbody_world.point_cache.frame_start
+
+            if scene.frame_current != frame:
+                for armature in self.armatures:
+                    if pose_fcurves(armature) is None:
+                        self.old_frame = scene.frame_current
+                        scene.frame_set(frame)
+                        break
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.old_frame is not None:
+            self.scene.frame_set(self.old_frame)
+
+        return False
+
+
+# Temporarily resets the armature's pose to the starting simulation frame.
+#
+# If the pose only depends on the armature's action then it evaluates the
+# action directly, which is much faster than changing the scene's frame.
 class AnimationFrame:
-    def __init__(self, context):
+    def __init__(self, context, armature):
+        self.context = context
         self.scene = context.scene
+        self.armature = armature
         self.old_frame = None
+        self.old_values = None
 
     def __enter__(self):
         scene = self.scene
 
         if scene.rigidbody_world:
-            self.old_frame = scene.frame_current
-            scene.frame_set(scene.rigidbody_world.point_cache.frame_start)
+            frame = scene.rigidbody_world.point_cache.frame_start
+
+            if scene.frame_current != frame:
+                fcurves = pose_fcurves(self.armature)
+
+                if fcurves is None:
+                    self.old_frame = scene.frame_current
+                    scene.frame_set(frame)
+
+                elif len(fcurves) > 0:
+                    self.set_pose(fcurves, frame)
+
+    def set_pose(self, fcurves, frame):
+        pose_bones = self.armature.pose.bones
+
+        self.old_values = []
+
+        for (name, attribute, fcurve) in fcurves:
+            pose_bone = pose_bones.get(name)
+
+            if pose_bone is not None:
+                index = fcurve.array_index
+                value = getattr(pose_bone, attribute)
+
+                if hasattr(value, "__setitem__"):
+                    self.old_values.append((pose_bone, attribute, index, value[index]))
+                    value[index] = fcurve.evaluate(frame)
+
+                else:
+                    self.old_values.append((pose_bone, attribute, None, value))
+                    setattr(pose_bone, attribute, fcurve.evaluate(frame))
+
+        # This only evaluates the armature (and the objects which depend on it)
+        self.context.view_layer.update()
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.old_values is not None:
+            for (pose_bone, attribute, index, value) in reversed(self.old_values):
+                if index is None:
+                    setattr(pose_bone, attribute, value)
+
+                else:
+                    getattr(pose_bone, attribute)[index] = value
+
         if self.old_frame is not None:
             self.scene.frame_set(self.old_frame)
 
@@ -177,15 +419,60 @@ def select_active(context, obj):
     context.view_layer.objects.active = obj
 
 
+# Counts how many property writes were performed or skipped
+WRITES = {
+    "performed": 0,
+    "skipped": 0,
+}
+
+def reset_writes():
+    WRITES["performed"] = 0
+    WRITES["skipped"] = 0
+
+def print_writes():
+    debug("  WRITES: {} performed, {} skipped".format(WRITES["performed"], WRITES["skipped"]))
+
+
+def is_same_value(old, new):
+    # Arrays (like vectors and collision_collections) are compared element by element
+    if hasattr(old, "__len__") and not isinstance(old, str):
+        if len(old) != len(new):
+            return False
+
+        for (x, y) in zip(old, new):
+            if x != y:
+                return False
+
+        return True
+
+    else:
+        return old == new
+
+
+# Writing to a property tags the depsgraph and can reset the rigid body cache,
+# even if the value didn't change, so this only writes if the value is different
+#
+# Returns True if the property was written
+def set_property(object, name, value):
+    if is_same_value(getattr(object, name), value):
+        WRITES["skipped"] += 1
+        return False
+
+    else:
+        setattr(object, name, value)
+        WRITES["performed"] += 1
+        return True
+
+
 def set_parent(child, parent):
-    child.parent = parent
-    child.parent_type = 'OBJECT'
+    set_property(child, "parent", parent)
+    set_property(child, "parent_type", 'OBJECT')
 
 
 def set_bone_parent(child, parent, bone):
-    child.parent = parent
-    child.parent_type = 'BONE'
-    child.parent_bone = bone
+    set_property(child, "parent", parent)
+    set_property(child, "parent_type", 'BONE')
+    set_property(child, "parent_bone", bone)
 
 
 def make_collection(name, parent):
@@ -224,12 +511,53 @@ def remove_collection_recursive(collection):
     bpy.data.collections.remove(collection)
 
 
+# Unit cube, the vertices are in the same order as bmesh.ops.create_cube
+CUBE_VERTICES = [
+    (x, y, z)
+    for x in (-0.5, 0.5)
+    for y in (-0.5, 0.5)
+    for z in (-0.5, 0.5)
+]
+
+CUBE_FACES = [
+    (1, 3, 2, 0),
+    (4, 6, 7, 5),
+    (4, 5, 1, 0),
+    (2, 3, 7, 6),
+    (2, 6, 4, 0),
+    (1, 5, 7, 3),
+]
+
+
 def set_mesh_cube(mesh, dimensions):
-    bm = bmesh.new()
-    bmesh.ops.create_cube(bm, size=1.0, calc_uvs=False)
-    bmesh.ops.scale(bm, vec=dimensions, verts=bm.verts)
-    bm.to_mesh(mesh)
-    bm.free()
+    # The cube is only created once, after that only the vertex positions are changed
+    is_new = len(mesh.vertices) != 8 or len(mesh.polygons) != 6
+
+    if is_new:
+        mesh.clear_geometry()
+        mesh.from_pydata(CUBE_VERTICES, [], CUBE_FACES)
+
+    (x, y, z) = dimensions
+
+    coordinates = []
+
+    for vertex in CUBE_VERTICES:
+        coordinates.append(vertex[0] * x)
+        coordinates.append(vertex[1] * y)
+        coordinates.append(vertex[2] * z)
+
+    # Updating the mesh is slow, so it is skipped if the vertices are the same
+    if not is_new:
+        old_coordinates = [0.0] * len(coordinates)
+        mesh.vertices.foreach_get("co", old_coordinates)
+
+        if old_coordinates == coordinates:
+            WRITES["skipped"] += 1
+            return
+
+    mesh.vertices.foreach_set("co", coordinates)
+    mesh.update()
+    WRITES["performed"] += 1
 
 
 def clear_mesh(mesh):
@@ -237,17 +565,113 @@ def clear_mesh(mesh):
     #      if that happens, change to use this implementation instead
     #set_mesh_cube(mesh, (0.0, 0.0, 0.0))
 
-    # TODO is there a faster way ?
-    bm = bmesh.new()
-    bm.to_mesh(mesh)
-    bm.free()
+    if len(mesh.vertices) != 0:
+        mesh.clear_geometry()
+
+
+def rigid_body_world(context):
+    scene = context.scene
+
+    if not scene.rigidbody_world:
+        bpy.ops.rigidbody.world_add()
+
+    return scene.rigidbody_world
+
+
+def rigid_body_objects(context):
+    world = rigid_body_world(context)
+
+    if not world.collection:
+        world.collection = bpy.data.collections.new("RigidBodyWorld")
+
+    return world.collection
+
+
+def rigid_body_constraints(context):
+    world = rigid_body_world(context)
+
+    if not world.constraints:
+        world.constraints = bpy.data.collections.new("RigidBodyConstraints")
+
+    return world.constraints
 
 
-def make_mesh_object(name, collection):
-    mesh = bpy.data.meshes.new(name=name)
-    cube = bpy.data.objects.new(name, mesh)
-    collection.objects.link(cube)
-    return cube
+# Linking an object into the rigid body world's collection creates the rigid body,
+# which is a lot faster than selecting the object and using bpy.ops.rigidbody.object_add
+def add_rigid_bodies(context, objects, type):
+    link = rigid_body_objects(context).objects.link
+
+    for object in objects:
+        link(object)
+
+    for object in objects:
+        # This should never happen, but just in case Blender didn't create the rigid body
+        if object.rigid_body is None:
+            select_active(context, object)
+            bpy.ops.rigidbody.object_add(type=type)
+
+        object.rigid_body.type = type
+
+
+def add_rigid_body(context, object, type):
+    add_rigid_bodies(context, [object], type)
+
+
+# Linking an object into the rigid body world's constraints creates the constraint,
+# which is a lot faster than selecting the object and using bpy.ops.rigidbody.constraint_add
+def add_rigid_body_constraint(context, object, type):
+    rigid_body_constraints(context).objects.link(object)
+
+    # This should never happen, but just in case Blender didn't create the constraint
+    if object.rigid_body_constraint is None:
+        select_active(context, object)
+
+        with Viewable(object):
+            bpy.ops.rigidbody.constraint_add(type=type)
+
+    object.rigid_body_constraint.type = type
+
+
+# The settings are (path, value) pairs, the path is a list of attribute names
+def set_attributes(object, settings):
+    for (path, value) in settings:
+        target = object
+
+        for name in path[:-1]:
+            target = getattr(target, name)
+
+        setattr(target, path[-1], value)
+
+
+# Creates many objects at once, the objects are returned in the same order as the names.
+#
+# The settings are (attribute, value) pairs which are set on every object,
+# the attribute can be a path like "display.show_shadows"
+#
+# All of the datablocks are created first, and then they are linked into the collection,
+# so that Blender doesn't need to switch between creating and linking.
+def make_objects(names, collection, settings=(), is_mesh=True):
+    settings = [(path.split("."), value) for (path, value) in settings]
+
+    if is_mesh:
+        objects = [bpy.data.objects.new(name, bpy.data.meshes.new(name=name)) for name in names]
+    else:
+        objects = [bpy.data.objects.new(name=name, object_data=None) for name in names]
+
+    link = collection.objects.link
+
+    for object in objects:
+        link(object)
+
+    if len(settings) > 0:
+        for object in objects:
+            set_attributes(object, settings)
+
+    return objects
+
+
+def make_mesh_object(name, collection, settings=()):
+    return make_objects([name], collection, settings)[0]
 
 
 re_strip = re.compile(r"\.[0-9]+$")
@@ -276,53 +700,341 @@ def make_unique_name(prefix, seen):
 EVENTS = {}
 
 
-def get_dirty(armature, scene):
-    # If the dirty already exists then return it
-    for dirty in scene.dirties:
-        # TODO better cherk for this ?
-        if dirty.armature and dirty.armature.name == armature.name:
-            return dirty
+# This is stored in memory (not in the .blend file), so marking
+# an armature as dirty doesn't create undo steps or write ID data.
+class Dirty:
+    def __init__(self, armature):
+        # The armature is looked up again by name, because the Object might be freed by undo
+        self.name = armature.name
+        self.pointer = armature.as_pointer()
+
+        # Names of the events which should run
+        self.events = set()
+
+        # Names of the bones which were changed, this is empty if all_bones is True
+        self.bones = set()
+        self.all_bones = False
+
+    @property
+    def update(self):
+        return "update" in self.events
+
+    def get_armature(self):
+        armature = bpy.data.objects.get(self.name)
+
+        if armature and armature.as_pointer() == self.pointer:
+            return armature
+
+        else:
+            return None
+
+
+# Armature pointer -> Dirty
+DIRTIES = {}
+
+
+def get_dirty(armature):
+    key = armature.as_pointer()
+
+    dirty = DIRTIES.get(key)
+
+    if dirty is None:
+        dirty = Dirty(armature)
+        DIRTIES[key] = dirty
 
-    # If it doesn't exist, create a new one
-    dirty = scene.dirties.add()
-    dirty.armature = armature
     return dirty
 
 
+re_bone_path = re.compile(r'^bones\["((?:[^"\\]|\\.)*)"\]')
+re_unescape = re.compile(r'\\(.)')
+
+# Returns the name of the bone which the properties belong to,
+# or None if the properties don't belong to a bone.
+def bone_name_from_path(data):
+    if data is None:
+        return None
+
+    match = re_bone_path.match(data.path_from_id())
+
+    if match:
+        return re_unescape.sub(r"\1", match.group(1))
+
+    else:
+        return None
+
+
+def mark_dirty_bone(dirty, name):
+    if not dirty.all_bones:
+        if name is None:
+            dirty.all_bones = True
+            dirty.bones.clear()
+
+        else:
+            dirty.bones.add(name)
+
+
+# Returns the bones which were changed, if it doesn't know which bones were changed then it returns all of them
+def dirty_bones(dirty, bones):
+    if dirty.all_bones:
+        return bones
+
+    else:
+        return [bones[name] for name in dirty.bones if name in bones]
+
+
 # This is used to run the event during the next main event tick.
 #
 # It also causes multiple update operations to be batched
 # into one operation, which makes Alt updating work correctly.
-def mark_dirty(context, name):
-    scene = context.scene.rigid_body_bones
-
+def mark_dirty(context, name, data=None):
     if is_armature(context):
-        armature = context.active_object
+        bone_name = bone_name_from_path(data)
+
+        if bone_name is None:
+            mark_armature_dirty(context.active_object, name)
+        else:
+            mark_armature_dirty(context.active_object, name, [bone_name])
+
+
+# This is the same as mark_dirty, except it works with any armature, not just the active armature
+def mark_armature_dirty(armature, name, bone_names=None):
+    dirty = get_dirty(armature)
+
+    if name in dirty.events:
+        SCHEDULE["coalesced"] += 1
+    else:
+        dirty.events.add(name)
+
+    if bone_names is None:
+        mark_dirty_bone(dirty, None)
+
+    else:
+        for bone_name in bone_names:
+            mark_dirty_bone(dirty, bone_name)
+
+    debug("DIRTY {} {} {}".format(armature.name, name, bone_names))
+
+    if name not in DISCRETE_EVENTS:
+        now = time.time()
+
+        # When a property changes again before it has settled, it is being dragged.
+        #
+        # The changes which happen before the next tick (e.g. Alt editing many bones)
+        # are a single action, so it's only a drag if the changes are in separate ticks.
+        if SCHEDULE["ticked"] and (now - SCHEDULE["last_dirty"]) < settle_delay():
+            SCHEDULE["dragging"] = True
 
-        dirty = get_dirty(armature, scene)
-        setattr(dirty, name, True)
+        SCHEDULE["ticked"] = False
+        SCHEDULE["last_dirty"] = now
 
-        debug("DIRTY {}".format(name))
+    # The events run on the next tick, unless a property is being dragged
+    if not bpy.app.timers.is_registered(tick_events):
+        bpy.app.timers.register(tick_events, first_interval=0.0)
 
-    if len(scene.dirties) > 0:
-        if not bpy.app.timers.is_registered(run_events):
-            bpy.app.timers.register(run_events)
 
+# Armature pointer -> names of the bones which must be reconciled by the next Update,
+# this is used when the target of a joint is in a different armature
+FORCED_BONES = {}
 
+def force_bones(armature, bone_names):
+    FORCED_BONES.setdefault(armature.as_pointer(), set()).update(bone_names)
+
+def take_forced_bones(armature):
+    return FORCED_BONES.pop(armature.as_pointer(), set())
+
+
+# Target armature pointer -> { dependent armature name -> { dependent bone name -> target bone names } }
+#
+# This is used to find the joints which are connected to bones in a different armature
+DEPENDENTS = {}
+
+
+def bone_dependencies(armature, data):
+    for joint in data.constraints:
+        target = joint.target
+
+        if target and target != armature and target.type == 'ARMATURE':
+            yield (target, joint.subtarget)
+
+
+# If bone_names is None then it updates all of the bones
+def update_dependents(armature, bone_names):
+    name = armature.name
+
+    for dependents in DEPENDENTS.values():
+        bones = dependents.get(name)
+
+        if bones:
+            if bone_names is None:
+                bones.clear()
+
+            else:
+                for bone_name in bone_names:
+                    bones.pop(bone_name, None)
+
+    for bone in armature.data.bones:
+        if bone_names is None or bone.name in bone_names:
+            for (target, subtarget) in bone_dependencies(armature, bone.rigid_body_bones):
+                dependents = DEPENDENTS.setdefault(target.as_pointer(), {})
+                bones = dependents.setdefault(name, {})
+                bones.setdefault(bone.name, set()).add(subtarget)
+
+
+# Marks the joints of other armatures which are connected to the changed bones
+#
+# If changed is None then it marks every joint which is connected to the armature
+def notify_dependents(armature, changed):
+    dependents = DEPENDENTS.get(armature.as_pointer())
+
+    if dependents:
+        for (name, bones) in dependents.items():
+            if changed is None:
+                bone_names = list(bones.keys())
+            else:
+                bone_names = [bone_name for (bone_name, targets) in bones.items() if not targets.isdisjoint(changed)]
+
+            if len(bone_names) > 0:
+                dependent = bpy.data.objects.get(name)
+
+                if dependent and dependent.type == 'ARMATURE':
+                    mark_armature_dirty(dependent, "dependents", bone_names)
+
+
+# The index is only stored in memory, so it is rebuilt after loading a file and after undo / redo
+def rebuild_dependents():
+    DEPENDENTS.clear()
+
+    for object in bpy.data.objects:
+        if object.type == 'ARMATURE' and object.data.rigid_body_bones.enabled:
+            update_dependents(object, None)
+
+
+# These are the caches of Update (in armatures.py), they are keyed by Armature pointer.
+#
+# They are only stored in memory, and the pointers can be reused by a different
+# file, so they are cleared after loading a file.
+BONE_STATES = {}
+BONE_DIGESTS = {}
+REGISTRIES = {}
+
+
+def clear_armature_caches():
+    BONE_STATES.clear()
+    BONE_DIGESTS.clear()
+    REGISTRIES.clear()
+
+
+# Statistics for the event scheduler
+SCHEDULE = {
+    # The last time that mark_dirty was called for an event which isn't discrete
+    "last_dirty": 0.0,
+    # Whether a property is being dragged, the events are delayed until it settles
+    "dragging": False,
+    # Whether tick_events has run since the last time that mark_dirty was called
+    "ticked": True,
+    # How many events were merged into an event which was already waiting to run
+    "coalesced": 0,
+    # How many times the preview events were run while a property was being dragged
+    "previews": 0,
+}
+
+# These events are cheap enough that they can run while a property is being dragged
+PREVIEW_EVENTS = ("align",)
+
+# These events are caused by a single action (not by dragging a property), so they are never delayed
+DISCRETE_EVENTS = ("mode", "load", "rename", "dependents")
+
+
+def get_preferences():
+    addon = bpy.context.preferences.addons.get(__package__)
+
+    if addon:
+        return addon.preferences
+
+    else:
+        return None
+
+
+def event_interval():
+    preferences = get_preferences()
+
+    if preferences:
+        return 1.0 / preferences.update_rate
+
+    else:
+        return 1.0 / 30.0
+
+
+def settle_delay():
+    preferences = get_preferences()
+
+    if preferences:
+        return preferences.settle_delay
+
+    else:
+        return 0.15
+
+
+# While a property is being dragged, mark_dirty is called many times a second.
+# Instead of running every event each time, this only runs the preview events
+# (at most update_rate times per second), and it runs the rest of the events
+# after the property hasn't changed for settle_delay seconds.
+#
+# Otherwise the events run immediately.
+def tick_events():
+    SCHEDULE["ticked"] = True
+
+    if SCHEDULE["dragging"] and (time.time() - SCHEDULE["last_dirty"]) < settle_delay():
+        run_preview_events()
+        return event_interval()
+
+    else:
+        SCHEDULE["dragging"] = False
+        run_events()
+
+        # The events marked other armatures as dirty (e.g. notify_dependents), this timer is
+        # still registered so mark_dirty didn't register a new timer, so it runs again on the next tick
+        if len(DIRTIES) > 0:
+            return 0.0
+
+        else:
+            return None
+
+
+@timed("run_preview_events")
+def run_preview_events():
+    context = bpy.context
+
+    SCHEDULE["previews"] += 1
+
+    for dirty in list(DIRTIES.values()):
+        armature = dirty.get_armature()
+
+        if armature:
+            for name in PREVIEW_EVENTS:
+                if name in dirty.events:
+                    dirty.events.remove(name)
+                    EVENTS[name](context, dirty, armature)
+
+
+# This runs all of the events immediately
 @timed("run_events")
 def run_events():
     context = bpy.context
-    scene = context.scene.rigid_body_bones
 
-    for dirty in scene.dirties:
-        armature = dirty.armature
+    # The events can mark armatures as dirty, so each Dirty is removed before its events run,
+    # that way the new marks are kept (even for armatures which already ran) and they run later
+    for (key, dirty) in list(DIRTIES.items()):
+        del DIRTIES[key]
+
+        armature = dirty.get_armature()
 
         if armature:
             for (name, f) in EVENTS.items():
-                if getattr(dirty, name):
+                if name in dirty.events:
                     f(context, dirty, armature)
 
-    scene.dirties.clear()
+    debug("  COALESCED: {} events, {} previews".format(SCHEDULE["coalesced"], SCHEDULE["previews"]))
 
 
 def event(name):
@@ -330,19 +1042,21 @@ def event(name):
         def run(context, dirty, armature):
             debug("EVENT {} {{".format(name))
 
+            reset_writes()
             time_start = time.time()
 
             f(context, dirty, armature)
 
             time_end = time.time()
             print_time(time_start, time_end)
+            print_writes()
 
             debug("}")
 
         EVENTS[name] = run
 
         def update(self, context):
-            mark_dirty(context, name)
+            mark_dirty(context, name, self)
 
         return update
     return decorator
@@ -373,5 +1087,10 @@ def if_armature_pose(f):
 
 
 def unregister():
-    if bpy.app.timers.is_registered(run_events):
-        bpy.app.timers.unregister(run_events)
+    if bpy.app.timers.is_registered(tick_events):
+        bpy.app.timers.unregister(tick_events)
+
+    DIRTIES.clear()
+    FORCED_BONES.clear()
+    DEPENDENTS.clear()
+    clear_armature_caches()
@@ -0,0 +1,156 @@
+# These test the event scheduler in utils.py outside of Blender, utils.py only
+# needs bpy and mathutils when the events run, so they are replaced with the
+# small parts of bpy that the scheduler uses
+import os
+import sys
+import types
+import importlib.util
+
+
+class Timers:
+    def __init__(self):
+        self.registered = set()
+
+    def is_registered(self, f):
+        return f in self.registered
+
+    def register(self, f, first_interval=0.0):
+        self.registered.add(f)
+
+    def unregister(self, f):
+        self.registered.discard(f)
+
+
+bpy = types.ModuleType("bpy")
+bpy.app = types.SimpleNamespace(timers=Timers())
+bpy.data = types.SimpleNamespace(objects={})
+bpy.context = types.SimpleNamespace(preferences=types.SimpleNamespace(addons={}))
+
+mathutils = types.ModuleType("mathutils")
+mathutils.Vector = mathutils.Euler = mathutils.Matrix = object
+
+sys.modules.setdefault("bpy", bpy)
+sys.modules.setdefault("mathutils", mathutils)
+
+
+UTILS_PATH = os.path.join(os.path.dirname(__file__), "..", "Rigid Body Bones", "utils.py")
+
+spec = importlib.util.spec_from_file_location("utils", UTILS_PATH)
+utils = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(utils)
+
+
+class Armature:
+    def __init__(self, name, bones=()):
+        self.name = name
+        self.type = 'ARMATURE'
+        self.data = types.SimpleNamespace(bones=list(bones))
+
+    def as_pointer(self):
+        return id(self)
+
+
+def joint_bone(name, target, subtarget):
+    joint = types.SimpleNamespace(target=target, subtarget=subtarget)
+    data = types.SimpleNamespace(constraints=[joint])
+    return types.SimpleNamespace(name=name, rigid_body_bones=data)
+
+
+def setup_armatures(monkeypatch):
+    target = Armature("B")
+    dependent = Armature("A", [joint_bone("Joint", target, "Target")])
+
+    monkeypatch.setattr(bpy.data, "objects", {"A": dependent, "B": target})
+    monkeypatch.setattr(utils, "settle_delay", lambda: 0.0)
+
+    utils.DIRTIES.clear()
+    utils.DEPENDENTS.clear()
+    utils.update_dependents(dependent, None)
+
+    return (dependent, target)
+
+
+def run_ticks():
+    ticks = 0
+
+    while utils.tick_events() is not None:
+        ticks += 1
+        assert ticks < 10
+
+    return ticks
+
+
+def test_target_change_rebuilds_dependent_joint(monkeypatch):
+    (dependent, target) = setup_armatures(monkeypatch)
+    rebuilt = []
+
+    def update(context, dirty, armature):
+        utils.notify_dependents(armature, set(dirty.bones))
+
+    def dependents(context, dirty, armature):
+        rebuilt.append((armature.name, sorted(dirty.bones)))
+
+    monkeypatch.setattr(utils, "EVENTS", {"update": update, "dependents": dependents})
+
+    utils.mark_armature_dirty(target, "update", ["Target"])
+
+    assert run_ticks() == 1
+    assert rebuilt == [("A", ["Joint"])]
+    assert utils.DIRTIES == {}
+
+
+def test_dependent_which_already_ran_is_marked_again(monkeypatch):
+    (dependent, target) = setup_armatures(monkeypatch)
+    ran = []
+    rebuilt = []
+
+    def update(context, dirty, armature):
+        ran.append(armature.name)
+        utils.notify_dependents(armature, set(dirty.bones))
+
+    def dependents(context, dirty, armature):
+        rebuilt.append((armature.name, sorted(dirty.bones)))
+
+    monkeypatch.setattr(utils, "EVENTS", {"update": update, "dependents": dependents})
+
+    # A runs before B in the same tick, so B marks A after A has already run
+    utils.mark_armature_dirty(dependent, "update", ["Joint"])
+    utils.mark_armature_dirty(target, "update", ["Target"])
+
+    run_ticks()
+
+    assert ran == ["A", "B"]
+    assert rebuilt == [("A", ["Joint"])]
+    assert utils.DIRTIES == {}
+
+
+def setup_schedule(monkeypatch):
+    monkeypatch.setattr(utils, "SCHEDULE", dict(utils.SCHEDULE, last_dirty=0.0, dragging=False, ticked=True))
+    monkeypatch.setattr(utils, "settle_delay", lambda: 10.0)
+    monkeypatch.setattr(utils, "EVENTS", {"update": lambda context, dirty, armature: None})
+
+
+def test_marks_in_the_same_tick_are_not_a_drag(monkeypatch):
+    (dependent, target) = setup_armatures(monkeypatch)
+    setup_schedule(monkeypatch)
+
+    utils.mark_armature_dirty(dependent, "update", ["Joint"])
+    utils.mark_armature_dirty(target, "update", ["Target"])
+    utils.mark_armature_dirty(target, "update", ["Other"])
+
+    assert not utils.SCHEDULE["dragging"]
+    assert utils.tick_events() is None
+    assert utils.DIRTIES == {}
+
+
+def test_marks_in_separate_ticks_are_a_drag(monkeypatch):
+    (dependent, target) = setup_armatures(monkeypatch)
+    setup_schedule(monkeypatch)
+
+    utils.mark_armature_dirty(target, "update", ["Target"])
+    assert utils.tick_events() is None
+
+    utils.mark_armature_dirty(target, "update", ["Target"])
+
+    assert utils.SCHEDULE["dragging"]
+    assert utils.tick_events() is not None
@@ -0,0 +1,127 @@
+# These test plans.py outside of Blender, it doesn't import the add-on
+# (which needs bpy), it only loads plans.py
+import os
+import importlib.util
+
+
+PLANS_PATH = os.path.join(os.path.dirname(__file__), "..", "Rigid Body Bones", "plans.py")
+
+spec = importlib.util.spec_from_file_location("plans", PLANS_PATH)
+plans = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(plans)
+
+
+class Object:
+    def __init__(self, name):
+        self.name = name
+
+
+class Owner:
+    def __init__(self, active=None, passive=None):
+        self.active = active
+        self.passive = passive
+
+
+def test_empty_plan():
+    plan = plans.Plan()
+
+    assert len(plan) == 0
+    assert plan.skipped == 0
+    assert all(len(slots) == 0 for slots in plan.creates.values())
+
+
+def test_keep_creates_missing_object():
+    plan = plans.Plan()
+    owner = Owner()
+
+    plan.keep('ACTIVE', "Bone", owner, "active", "Bone [Active]")
+
+    assert len(plan) == 1
+    assert plan.skipped == 0
+    assert plan.renames == []
+
+    [slot] = plan.creates['ACTIVE']
+
+    assert slot.kind == 'ACTIVE'
+    assert slot.bone == "Bone"
+    assert slot.owner is owner
+    assert slot.attribute == "active"
+    assert slot.name == "Bone [Active]"
+
+
+def test_keep_renames_object_with_wrong_name():
+    plan = plans.Plan()
+    object = Object("Old [Active]")
+    owner = Owner(active=object)
+
+    plan.keep('ACTIVE', "Bone", owner, "active", "Bone [Active]")
+
+    assert len(plan) == 1
+    assert plan.skipped == 0
+    assert plan.renames == [(object, "Bone [Active]")]
+    assert plan.creates['ACTIVE'] == []
+
+
+def test_keep_skips_object_with_correct_name():
+    plan = plans.Plan()
+    owner = Owner(active=Object("Bone [Active]"))
+
+    plan.keep('ACTIVE', "Bone", owner, "active", "Bone [Active]")
+
+    assert len(plan) == 0
+    assert plan.skipped == 1
+    assert plan.renames == []
+    assert plan.creates['ACTIVE'] == []
+
+
+def test_remove_existing_object():
+    plan = plans.Plan()
+    owner = Owner(passive=Object("Bone [Passive]"))
+
+    plan.remove(owner, "passive")
+
+    assert len(plan) == 1
+    assert plan.skipped == 0
+    assert plan.removes == [(owner, "passive")]
+
+
+def test_remove_skips_missing_object():
+    plan = plans.Plan()
+    owner = Owner()
+
+    plan.remove(owner, "passive")
+
+    assert len(plan) == 0
+    assert plan.skipped == 1
+    assert plan.removes == []
+
+
+def test_len_counts_creates_renames_and_removes():
+    plan = plans.Plan()
+
+    plan.keep('ACTIVE', "A", Owner(), "active", "A [Active]")
+    plan.keep('PASSIVE', "B", Owner(), "passive", "B [Passive]")
+    plan.keep('ACTIVE', "C", Owner(active=Object("Old")), "active", "C [Active]")
+    plan.keep('ACTIVE', "D", Owner(active=Object("D [Active]")), "active", "D [Active]")
+    plan.remove(Owner(passive=Object("E [Passive]")), "passive")
+    plan.remove(Owner(), "passive")
+
+    assert len(plan) == 4
+    assert plan.skipped == 2
+    assert plan.summary() == "PLAN 2 creates, 1 renames, 1 removes, 2 skipped"
+
+
+def test_fill_slots():
+    plan = plans.Plan()
+    first = Owner()
+    second = Owner()
+
+    plan.keep('ACTIVE', "A", first, "active", "A [Active]")
+    plan.keep('ACTIVE', "B", second, "active", "B [Active]")
+
+    objects = [Object("A [Active]"), Object("B [Active]")]
+
+    plans.fill_slots(plan.creates['ACTIVE'], objects)
+
+    assert first.active is objects[0]
+    assert second.active is objects[1]